@@ -2,11 +2,13 @@
 import os
 import csv
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import Response
 import pathlib
 
 from typing_extensions import Annotated
 from pydantic.functional_validators import BeforeValidator
 
+from . import metrics
 from .models import Settings
 
 PyObjectId = Annotated[str, BeforeValidator(str)]
@@ -18,6 +20,7 @@ settings = Settings()
 
 def create_app():
     app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
 
     @app.on_event("startup")
     async def startup_event():
@@ -26,6 +29,13 @@ def create_app():
         (pathlib.Path(settings.INSTANCE_PATH) / 'original').mkdir(exist_ok=True, mode=0o777, parents=True)
         (pathlib.Path(settings.INSTANCE_PATH) / 'generated').mkdir(exist_ok=True, mode=0o777, parents=True)
 
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        """
+        Returns the metrics of this process in the Prometheus text format.
+        """
+        return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE)
+
     return app
 
 
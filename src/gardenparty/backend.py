@@ -1,24 +1,104 @@
+import asyncio
 import json
 import logging
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import re
 
 from pydantic import BaseModel, Field
-from .app import create_app, settings
+from .app import create_app, get_pkg_path, settings
+from .cache import ResultCache, cache_key, file_digest
+from .metrics import CACHE_LOOKUPS, EXTERNAL_CALL_SECONDS, GENERATIONS
+from . import providers
+from .providers import ContentRejected, InvalidResponse, ProviderError, ProviderUnavailable, RateLimited
+from .jobs import Job, JobQueue, ProviderLimits, QueueFull
+from .singleflight import SingleFlight
+from .themes import ThemeRegistry
+from .uploads import UploadCache
 import base64
-from fastapi import FastAPI
-from openai import OpenAI
-import os
+import functools
+import httpx
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 import pathlib
-import requests
-from typing import Union, Dict # use together with FastAPI
+from typing import Union, Dict, Iterator, List, Optional, Tuple # use together with FastAPI
 
 from jinja2 import Template
 
 app = create_app()
 
+
+@app.on_event("shutdown")
+def shutdown_event():
+    jobs.stop()
+    pipeline_executor.shutdown(wait=False, cancel_futures=True)
+    describe_executor.shutdown(wait=False)
+    providers.close()
+
+
+@app.exception_handler(ProviderError)
+def provider_error_handler(request, e: ProviderError):
+    """Respond to failed calls to the AI service providers with the matching status."""
+    headers = None
+    if isinstance(e, ContentRejected):
+        status_code = 422
+    elif isinstance(e, RateLimited):
+        status_code = 503
+        headers = {"Retry-After": str(math.ceil(e.retry_after or settings.JOB_RETRY_AFTER))}
+    else:
+        status_code = 502
+    content = {'detail': str(e), 'error': type(e).__name__, 'provider': e.provider}
+    return JSONResponse(status_code=status_code, content=content, headers=headers)
+
 logger = logging.getLogger(__name__)
 
+# Model used for describing the scanned drawings
+DESCRIBE_IMAGE_MODEL = "gpt-4o-mini"
+
+# Model used for merging the theme with the description into an image generation prompt
+MERGE_MODEL = "gpt-4o-mini"
+
+# Descriptions by the content of the image, the model and the prompt
+description_cache = ResultCache(
+    Path(settings.INSTANCE_PATH) / 'cache' / 'descriptions',
+    max_bytes=settings.DESCRIPTION_CACHE_BYTES,
+    max_items=settings.DESCRIPTION_CACHE_ITEMS,
+)
+
+# Generations run in the background by a pool of workers, and the number of concurrent calls to each provider
+jobs = JobQueue(workers=settings.JOB_WORKERS, max_queued=settings.JOB_QUEUE_SIZE)
+provider_limits = ProviderLimits({'openai': settings.OPENAI_CONCURRENCY, 'stability': settings.STABILITY_CONCURRENCY})
+
+# Runs the blocking calls of the generation pipelines, including the parallel variants of each job
+pipeline_executor = ThreadPoolExecutor(
+    max_workers=settings.JOB_WORKERS * (max(1, settings.GENERATION_VARIANTS) + 1), thread_name_prefix="pipeline"
+)
+
+# Reads the streamed image descriptions from OpenAI, at the pace they arrive whatever the pace of the readers
+describe_executor = ThreadPoolExecutor(max_workers=settings.OPENAI_CONCURRENCY, thread_name_prefix="describe-stream")
+
+# Scans and generated images shrunk for uploading, by their content
+upload_cache = UploadCache(max_bytes=settings.UPLOAD_CACHE_BYTES)
+
+# Identical calls in flight, which wait for the first one instead of making their own
+describe_flight = SingleFlight('describe_image')
+merge_flight = SingleFlight('merge_template_prompt')
+image_flight = SingleFlight('image_to_image')
+merge_job_flight = SingleFlight('merge_job')
+
+# Themes of the image generation prompts, shared with the frontend
+theme_registry = ThemeRegistry(get_pkg_path() / 'prompt_templates')
+
+# Merged image generation prompts by the theme, the description, the model and the prompt
+merge_cache = ResultCache(
+    Path(settings.INSTANCE_PATH) / 'cache' / 'merges',
+    max_bytes=settings.MERGE_CACHE_BYTES,
+    max_items=settings.MERGE_CACHE_ITEMS,
+)
+
 
 # Prompts. They are in Jinja2 format.
 DESCRIBE_IMAGE_PROMPT = """
@@ -56,42 +136,38 @@ You MUST Write response in the following json format:
 ```
 """
 
+@functools.lru_cache(maxsize=128)
+def compile_template(template: str) -> Template:
+    """Return the compiled Jinja2 template of `template`, compiling each template text only once."""
+    return Template(template)
+
+
 def gen_prompt(template: str, **kwargs):
     """Render a prompt template with the given keyword arguments."""
-    return Template(template).render(**kwargs)
+    return compile_template(template).render(**kwargs)
 
 
 # Add routes
 @app.get("/all_templates")
 def get_templates() -> Dict:
     """Returns a dictionary object with the list of templates to select."""
-    if os.path.exists("./src/gardenparty/prompt_templates"):
-        files = []
-        print("Prompt templates exists")
-        for root, dirnames, filenames in os.walk('./src/gardenparty/prompt_templates/'):
-            for filename in filenames:
-                files.append(os.path.join(root, filename))
-        
-        return {'files':files}
+    if theme_registry.exists():
+        return {'files': [str(path) for path in theme_registry.paths()]}
     return {'files':None}
 
 
-@app.get("/describe_image/{img}")
-def describe_image(img:str) -> Dict:
-    """Using OpenAI describe the content of given image."""
+def description_key(input_filename: Path, prompt: str) -> str:
+    """Key of the cached description of the image, by its content, the model, the prompt and the upload settings."""
+    detail = f"{settings.DESCRIBE_IMAGE_SIZE}:{settings.DESCRIBE_IMAGE_DETAIL}"
+    return cache_key(file_digest(input_filename), DESCRIBE_IMAGE_MODEL, prompt, detail)
 
-    # You can try with: ./original/hunger_in_the_olden_days.jpg
-    input_filename = settings.INSTANCE_PATH / "original" / img
-    print('input_filename: ', input_filename)
-    print('os.getcwd(): ', os.getcwd())
 
-    # Function to encode the image
-    def encode_image(image_path):
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+def description_request(input_filename: Path, prompt: str) -> Tuple[Dict, Dict]:
+    """Return the headers and the body of the chat completion request describing the image."""
 
-    # Getting the base64 string
-    base64_image = encode_image(input_filename)
+    # Getting the base64 string of the image, shrunk to the resolution the model looks at
+    upload = upload_cache.get(input_filename, max_side=settings.DESCRIBE_IMAGE_SIZE)
+    base64_image = base64.b64encode(upload).decode('ascii')
 
     if not settings.OPENAI_API_KEY:
         raise RuntimeError("OpenAI API key not set")
@@ -102,11 +178,9 @@ def describe_image(img:str) -> Dict:
         "Authorization": f"Bearer {settings.OPENAI_API_KEY}"
     }
 
-    prompt = gen_prompt(DESCRIBE_IMAGE_PROMPT)    
-
     # set encoded image to request body
     payload = {
-        "model": "gpt-4o-mini",
+        "model": DESCRIBE_IMAGE_MODEL,
         "messages": [
             {
             "role": "user",
@@ -118,7 +192,8 @@ def describe_image(img:str) -> Dict:
                 {
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image}"
+                    "url": f"data:image/jpeg;base64,{base64_image}",
+                    "detail": settings.DESCRIBE_IMAGE_DETAIL,
                 }
                 }
             ]
@@ -126,38 +201,201 @@ def describe_image(img:str) -> Dict:
         ],
         "max_tokens": 600
     }
+    return headers, payload
 
-    # get description
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
 
-    #print(response.json()['choices'][0]['message']['content'])
+@app.get("/describe_image/{img}")
+def describe_image(img:str) -> Dict:
+    """Using OpenAI describe the content of given image."""
+
+    # You can try with: ./original/hunger_in_the_olden_days.jpg
+    input_filename = settings.INSTANCE_PATH / "original" / img
+    logger.debug("Describing image %s", input_filename)
+
+    prompt = gen_prompt(DESCRIBE_IMAGE_PROMPT)
+
+    # The same scan is often uploaded again, and generated images are described again
+    key = description_key(input_filename, prompt)
+    description = description_cache.get(key)
+    CACHE_LOOKUPS.inc(cache='descriptions', result='miss' if description is None else 'hit')
+    if description is not None:
+        return {'img': input_filename, 'reply': description}
 
-    logger.info(f"Image description: {response.json()}")
+    headers, payload = description_request(input_filename, prompt)
+
+    # get description
+    def post():
+        with provider_limits.acquire('openai'), EXTERNAL_CALL_SECONDS.time(call='describe_image'):
+            return providers.get_http_client().post(providers.OPENAI_CHAT_URL, headers=headers, json=payload)
+
+    def fetch() -> str:
+        response = providers.call('openai', post, model=DESCRIBE_IMAGE_MODEL)
+        logger.debug("Image description response: %s", response.text)
+        try:
+            description = response.json()['choices'][0]['message']['content']
+        except (ValueError, LookupError, TypeError):
+            raise InvalidResponse('openai', f"Unexpected image description response: {response.text[:500]}") from None
+        description_cache.set(key, description)
+        return description
+
+    # Identical requests in flight, streamed or not, such as from a double click, wait for the first one
+    description = describe_flight.do(key, fetch)
 
     # return reply in a dict
-    return {'img': input_filename, 'reply':response.json()['choices'][0]['message']['content']}
+    return {'img': input_filename, 'reply':description}
+
+
+class StreamedText:
+    """
+    Text written in pieces by one thread, and read as it arrives by any number of others.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pieces: List[str] = []
+        self._closed = False
+
+    def write(self, piece: str) -> None:
+        with self._condition:
+            self._pieces.append(piece)
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __iter__(self) -> Iterator[str]:
+        """Yield the pieces written so far, then the others as they are written, until the text is closed."""
+        read = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: read < len(self._pieces) or self._closed)
+                pieces, closed = self._pieces[read:], self._closed
+            read += len(pieces)
+            # Yielded without the lock, the readers may take their time
+            yield from pieces
+            if closed:
+                return
+
+
+# Descriptions being streamed from OpenAI by their cache key, for the identical requests to follow
+description_streams: Dict[str, StreamedText] = {}
+description_streams_lock = threading.Lock()
+
+
+def read_description_stream(key: str, headers: Dict, payload: Dict, text: StreamedText) -> str:
+    """Stream the description requested by `payload` from OpenAI into `text`, and return and cache the whole of it."""
+    client = providers.get_http_client()
+
+    def send():
+        request = client.build_request(
+            "POST", providers.OPENAI_CHAT_URL, headers=headers, json={**payload, "stream": True}
+        )
+        return client.send(request, stream=True)
+
+    pieces = []
+    try:
+        # The call slot is held until the whole description has arrived, however slowly it is read
+        with provider_limits.acquire('openai'), EXTERNAL_CALL_SECONDS.time(call='describe_image_stream'):
+            response = providers.call('openai', send, model=DESCRIBE_IMAGE_MODEL)
+            try:
+                # Server-sent events, one chunk of the completion in each
+                for line in response.iter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        choices = json.loads(data)['choices']
+                        piece = choices[0]['delta'].get('content') if choices else None
+                    except (ValueError, LookupError, TypeError, AttributeError):
+                        raise InvalidResponse('openai', f"Unexpected image description chunk: {data[:500]}") from None
+                    if piece:
+                        pieces.append(piece)
+                        text.write(piece)
+            except httpx.TransportError as e:
+                raise ProviderUnavailable('openai', f"Image description stream broke: {e}") from e
+            finally:
+                response.close()
+        description = "".join(pieces)
+        description_cache.set(key, description)
+        return description
+    finally:
+        with description_streams_lock:
+            if description_streams.get(key) is text:
+                del description_streams[key]
+        text.close()
+
+
+def stream_description(img: str) -> Iterator[str]:
+    """
+    Describe the content of the image like `describe_image`, yielding the description in pieces as they arrive.
+    """
+    input_filename = settings.INSTANCE_PATH / "original" / img
+    logger.debug("Describing image %s, streaming", input_filename)
+
+    prompt = gen_prompt(DESCRIBE_IMAGE_PROMPT)
+
+    key = description_key(input_filename, prompt)
+    description = description_cache.get(key)
+    CACHE_LOOKUPS.inc(cache='descriptions', result='miss' if description is None else 'hit')
+    if description is not None:
+        yield description
+        return
+
+    headers, payload = description_request(input_filename, prompt)
+
+    # Identical requests in flight, streamed or not, share one call. The stream is read from OpenAI in the background,
+    # so a slow or abandoned reader doesn't keep the call slot from the others.
+    text = StreamedText()
+    with description_streams_lock:
+        future, leader = describe_flight.start(
+            key, describe_executor, read_description_stream, key, headers, payload, text
+        )
+        if leader:
+            description_streams[key] = text
+        else:
+            text = description_streams.get(key)
+    if text is None:
+        # The call in flight doesn't stream, or hasn't started yet
+        yield future.result()
+        return
+    yield from text
+    # Raises the error of the call, if it failed
+    future.result()
+
+
+@app.get("/describe_image/{img}/stream")
+def describe_image_stream(img: str):
+    """Describe the content of given image, streaming the description as plain text as it is written."""
+    if img != Path(img).name or not (settings.INSTANCE_PATH / 'original' / img).is_file():
+        raise HTTPException(status_code=404, detail=f"Image {img!r} not found")
+    return StreamingResponse(stream_description(img), media_type="text/plain; charset=utf-8")
 
 
 # calls to server and external 3rd parties
 def some_llm_provider(prompt:str) -> Dict: 
     """Use some LLM provider to get a response to prompt."""
 
-    # set up client credentials
-    client = OpenAI(
-            api_key=settings.OPENAI_API_KEY,
-            )
+    client = providers.get_openai_client()
 
     # make the call with chosen model
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {
-                "role": "user",
-                "content": f"Explain what is this: {prompt}"
-            }
-        ]
-    )
+    def create():
+        with provider_limits.acquire('openai'), EXTERNAL_CALL_SECONDS.time(call='call_llm'):
+            return client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {
+                        "role": "user",
+                        "content": f"Explain what is this: {prompt}"
+                    }
+                ]
+            )
+
+    completion = providers.call('openai', create, model="gpt-4o-mini")
 
     # return reply in a dict
     #print(completion.choices[0].message)
@@ -175,49 +413,65 @@ def get_llm_response(prompt:str) -> Dict:
 @app.get("/img_to_image/{img}/{prompt}")
 def image_to_image(img:str, prompt:str, negative_prompt:str="", seed:int=42, strength:float=0.6):
     """Image to image using stable diffusion's service. Please note that the image file name must end with .jpg not .jpeg."""
-    
+    content = generate_image_content(img, prompt, negative_prompt, seed, strength)
+
+    output_filename = settings.INSTANCE_PATH / 'generated'/ f"{img}"
+    output_filename = str(output_filename)
+    with open(output_filename, 'wb') as file:
+        file.write(content)
+
+    return {"result": 200, "prompt":prompt, "strength":strength, "seed":seed, 'output_filename': output_filename}
+
+
+def generate_image_content(
+    img: str, prompt: str, negative_prompt: str = "", seed: int = 42, strength: float = 0.6
+) -> bytes:
+    """Generate an image from the scanned drawing `img` with Stability AI, and return the JPEG."""
+
     # You can try with: ./original/hunger_in_the_olden_days.jpg
     input_filename = settings.INSTANCE_PATH / 'original' / img
+    logger.debug("Generating image from %s", input_filename)
+
+    # Shrunk to the size of the generated image, the service works at that size anyway
+    upload = upload_cache.get(input_filename, max_pixels=settings.IMAGE_TO_IMAGE_PIXELS)
+
+    def post():
+        with provider_limits.acquire('stability'), EXTERNAL_CALL_SECONDS.time(call='image_to_image'):
+            return providers.get_http_client().post(
+                providers.STABILITY_SD3_URL,
+                headers={
+                    "authorization": f"Bearer {settings.STABILITYAI_API_KEY}",
+                    "accept": "image/*"
+                },
+                files={
+                    "image": (Path(img).name, upload, "image/jpeg"),
+                },
+                data={
+                    "prompt": prompt,
+                    "negative_prompt": negative_prompt,
+                    "output_format": "jpeg",
+                    "strength":strength,
+                    "mode":"image-to-image",
+                    "model":"sd3-medium",
+                    "seed":seed
+                },
+            )
 
-    print('settings.original_images_dir: ', input_filename)
-        
-    response = requests.post(
-        f"https://api.stability.ai/v2beta/stable-image/generate/sd3",
-        headers={
-            "authorization": f"Bearer {settings.STABILITYAI_API_KEY}",
-            "accept": "image/*"
-        },
-        files={
-            "image": open(input_filename, "rb"),
-        },
-        data={
-            "prompt": prompt,
-            "negative_prompt": negative_prompt,
-            "image": input_filename,
-            "output_format": "jpeg",
-            "strength":strength,
-            "mode":"image-to-image",
-            "model":"sd3-medium",
-            "seed":seed
-        },
-    )
-
-    if response.status_code == 200:
-        print("200")
-        output_filename = settings.INSTANCE_PATH / 'generated'/ f"{img}"
-        output_filename = str(output_filename)
-        with open(output_filename, 'wb') as file:
-            file.write(response.content)
+    # The seed makes the result depend only on the image and the parameters
+    key = cache_key(file_digest(input_filename), prompt, negative_prompt, str(seed), str(strength))
+    try:
+        response = image_flight.do(key, providers.call, 'stability', post, model="sd3-medium")
+    except ContentRejected:
+        GENERATIONS.inc(result='content_moderation')
+        raise
+    except ProviderError as e:
+        GENERATIONS.inc(result='error')
+        logger.warning("Image generation failed: %s", e)
+        raise
 
-        return {"result": 200, "prompt":prompt, "strength":strength, "seed":seed, 'output_filename': output_filename}
+    GENERATIONS.inc(result='ok')
+    return response.content
 
-    else:
-        if response.json()['name'] == 'content_moderation':
-            return {"result": "Dirty word detected!", "prompt":prompt, "strength":strength, "seed":seed, "response": str(response.json())}
-        else:
-            print("No luck!")
-            return response.json()
-        
 
 def merge_template_prompt(prompt_template:str, description:str):
     """Merge selected prompt template with description of the scanned image."""
@@ -232,26 +486,34 @@ def merge_template_prompt(prompt_template:str, description:str):
     #     On the right, there is a sketch of an animal that resembles a pig. 
     #     The overall scene suggests a possible hunting or spear-throwing scenario involving the animal."""
 
-    # set up client credentials
-    client = OpenAI(
-            api_key=settings.OPENAI_API_KEY,
-            )
+    # The same theme and description are merged again when an image is regenerated
+    key = cache_key(MERGE_PROMPTS_PROMPT, prompt_template, description, MERGE_MODEL)
+    cached = merge_cache.get(key)
+    CACHE_LOOKUPS.inc(cache='merges', result='miss' if cached is None else 'hit')
+    if cached is not None:
+        return {'prompt_template': prompt_template, 'description': description, **cached}
+
+    client = providers.get_openai_client()
 
     prompt = gen_prompt(MERGE_PROMPTS_PROMPT, prompt_template=prompt_template, description=description)
 
-    print(prompt)
+    logger.debug("Merge prompt: %s", prompt)
 
     # make the call with chosen model
-    completion = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {
-                "role": "user",
-                "content": prompt
-            }   
-        ]
-    )
+    def create():
+        with provider_limits.acquire('openai'), EXTERNAL_CALL_SECONDS.time(call='merge_template_prompt'):
+            return client.chat.completions.create(
+                model=MERGE_MODEL,
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }   
+                ]
+            )
+
+    completion = merge_flight.do(key, providers.call, 'openai', create, model=MERGE_MODEL)
     
     response = completion.choices[0].message.content
     response_prompt = response
@@ -267,6 +529,11 @@ def merge_template_prompt(prompt_template:str, description:str):
         response_negative_prompt = data["negative_prompt"]
     except Exception as e:
         logger.error("Error extracting JSON block: %r", e)
+    else:
+        # Only cache well-formed replies, a malformed one may come out right when asked again
+        merge_cache.set(
+            key, {'reply': response, 'prompt': response_prompt, 'negative_prompt': response_negative_prompt}
+        )
  
     # return reply in a dict
     #print(completion.choices[0].message)
@@ -285,41 +552,237 @@ async def merged_prompt_to_image(prompt_template_name:str, img:str, strength:flo
     """Take prompt template name and image name. return merged prompt text."""
 
     # get prompt template content
-    prompt_template = None
-    prompt_template_path = os.path.join('./src/gardenparty/prompt_templates', prompt_template_name)
-    with open(prompt_template_path, 'r') as f:
-        prompt_template = f.readlines()[0]
+    try:
+        prompt_template = theme_registry.get(prompt_template_name).text.splitlines()[0]
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Theme {prompt_template_name!r} not found")
 
-    #print("prompt_template OK")
+    async def run() -> Dict:
+        job = submit_job(merge_job, prompt_template, img, strength)
+        await run_in_threadpool(job.wait)
+        if job.status == 'failed':
+            raise_job_error(job)
+        return job.result
 
-    # get description
+    # Requests for the same image in flight get the result of the first one
+    return await merge_job_flight.do_async((prompt_template, img, strength), run)
+
+
+def merge_job(job: Job, prompt_template: str, img: str, strength: float) -> Dict:
+    """
+    Job making a new image from `img` with a prompt merged from the template and a description of the image.
+    """
+    job.set_stage('describe')
     description = describe_image(img)['reply']
-    #print("description OK")
 
-    # new merged prompt
+    job.set_stage('merge')
     prompt = merge_template_prompt(prompt_template, description)['reply']
-    #print("prompt OK")
-    # make the new image
-    response = await image_to_image(img, prompt, seed=42, strength=strength)
-    #print("response OK")
-    print(response)
+
+    job.set_stage('image')
+    response = image_to_image(img, prompt, seed=42, strength=strength)
+    logger.debug("Merged image response: %s", response)
     return response
 
 
+def generate_job(job: Job, img: str, theme: str, description: str) -> Dict:
+    """
+    Job generating an image from the scanned drawing `img`, a theme and a description of the drawing.
+    """
+    return asyncio.run(generate_pipeline(img, theme, description, job.set_stage))
+
+
+async def generate_pipeline(img: str, theme: str, description: str, set_stage=None) -> Dict:
+    """
+    Generate an image from the scanned drawing `img`, a theme and a description of the drawing.
+
+    The image is generated twice, the second time from a description of the first result. Each time, with
+    `GENERATION_VARIANTS` over 1, several images are generated in parallel with different seeds and strengths, and the
+    first one to succeed is used. `set_stage` is called with the name of each step as it starts.
+    """
+    loop = asyncio.get_running_loop()
+    set_stage = set_stage or (lambda stage: None)
+
+    set_stage('prompt')
+    generative_prompt = await loop.run_in_executor(pipeline_executor, generate_themed_prompt, theme, description)
+
+    set_stage('image')
+    first, _ = await generate_variants(img, generative_prompt["prompt"], generative_prompt["negative_prompt"])
+    first_filename = settings.INSTANCE_PATH / 'generated' / img
+    first_filename.write_bytes(first['content'])
+
+    set_stage('refine_prompt')
+    description2 = (await loop.run_in_executor(pipeline_executor, describe_image, str(first_filename)))['reply']
+    generative_prompt = await loop.run_in_executor(pipeline_executor, generate_themed_prompt, theme, description2)
+
+    set_stage('refine_image')
+    best, others = await generate_variants(
+        img, generative_prompt["prompt"], generative_prompt["negative_prompt"], keep=settings.GENERATION_KEEP_VARIANTS
+    )
+    output_filename = settings.INSTANCE_PATH / 'generated' / img
+    output_filename.write_bytes(best['content'])
+
+    # The others are kept out of the gallery, which shows every image in the generated directory
+    variants = []
+    for variant in others:
+        path = settings.INSTANCE_PATH / 'variants' / f"{Path(img).stem}-{variant['seed']}-{variant['strength']}.jpg"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(variant['content'])
+        variants.append(str(path))
+
+    return {
+        "result": 200,
+        "prompt": generative_prompt["prompt"],
+        "strength": best['strength'],
+        "seed": best['seed'],
+        'output_filename': str(output_filename),
+        'variants': variants,
+    }
+
+
+def log_dropped_variant(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.debug("Dropped image generation failed: %r", future.exception())
+
+
+async def generate_variants(img: str, prompt: str, negative_prompt: str, keep: bool = False):
+    """
+    Generate `GENERATION_VARIANTS` images from `img` in parallel, and return the first to succeed and the others.
+
+    The others are only waited for if `keep` is true, otherwise they finish in the background and are dropped. Raises
+    the error of the first failure if none succeeds.
+    """
+    strengths = settings.GENERATION_STRENGTHS
+    # The executor's futures by the asyncio futures they are raced with, and the options of each
+    options = {}
+    for number in range(max(1, settings.GENERATION_VARIANTS)):
+        seed, strength = 42 + number, strengths[number % len(strengths)]
+        future = pipeline_executor.submit(generate_image_content, img, prompt, negative_prompt, seed, strength)
+        options[asyncio.wrap_future(future)] = (future, {'seed': seed, 'strength': strength})
+
+    results, errors = [], []
+    pending = set(options)
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is not None:
+                errors.append(future.exception())
+            else:
+                results.append({**options[future][1], 'content': future.result()})
+        if results and not keep:
+            break
+
+    for future in pending:
+        # Dropped, and logged from the executor's future, as the event loop of the job may be closed before they finish
+        options[future][0].add_done_callback(log_dropped_variant)
+        # Retrieved, so that the event loop doesn't report the failures as never retrieved
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+    if not results:
+        raise errors[0]
+    return results[0], results[1:]
+
+
+def submit_job(func, *args, key: Optional[str] = None) -> Job:
+    """Queue a job, or respond with 503 if the queue is full. See `JobQueue.submit_once()` for `key`."""
+    try:
+        if key is not None:
+            return jobs.submit_once(key, func, *args)
+        return jobs.submit(func, *args)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(settings.JOB_RETRY_AFTER)})
+
+
+def generation_key(img: str, theme: str, description: str) -> str:
+    """Key of the generation jobs of the same drawing, named by its content hash, theme and description."""
+    return cache_key('generate', img, theme, description)
+
+
+class GenerationRequest(BaseModel):
+    img: str
+    description: str
+    theme: str = "ei_teemaa"
+
+
+def job_status(job: Job) -> Dict:
+    return {**job.to_dict(), 'position': jobs.position(job)}
+
+
+def raise_job_error(job: Job):
+    """Raise the error of a failed job, the errors of the providers as they are and others as 502."""
+    if isinstance(job.exception, ProviderError):
+        raise job.exception
+    raise HTTPException(status_code=502, detail=job.error)
+
+
+def get_job_or_404(job_id: str) -> Job:
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@app.post("/jobs", status_code=202)
+def submit_generation(request: GenerationRequest) -> Dict:
+    """Queue the generation of an image, and return the job, whose status can be polled at /jobs/{id}."""
+    if request.img != Path(request.img).name or not (settings.INSTANCE_PATH / 'original' / request.img).is_file():
+        raise HTTPException(status_code=404, detail=f"Image {request.img!r} not found")
+    try:
+        theme_registry.get(request.theme)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Theme {request.theme!r} not found")
+
+    key = generation_key(request.img, request.theme, request.description)
+    job = submit_job(generate_job, request.img, request.theme, request.description, key=key)
+    return job_status(job)
+
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str) -> Dict:
+    """Returns the status of a job, and its result once it is done."""
+    return job_status(get_job_or_404(job_id))
+
+
+@app.get("/jobs/{job_id}/result")
+def get_job_result(job_id: str, response: Response):
+    """Returns the result of a finished job, or its status with 202 while it is still queued or running."""
+    job = get_job_or_404(job_id)
+    if job.status == 'failed':
+        raise_job_error(job)
+    if job.status != 'done':
+        response.status_code = 202
+        return job_status(job)
+    return job.result
+
+
+@app.get("/jobs/{job_id}/events")
+async def get_job_events(job_id: str):
+    """Server-Sent Events stream of the status of a job, ending when the job is finished."""
+    job = get_job_or_404(job_id)
+
+    async def events():
+        version = None
+        while True:
+            current = job.version
+            status = job_status(job)
+            if current != version:
+                version = current
+                yield f"event: status\ndata: {json.dumps(status)}\n\n"
+            if job.done:
+                return
+            if not await run_in_threadpool(job.wait, version, 15):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 def generate_themed_prompt(theme, context):
     """
     Combine theme and context to generate an prompt.
     """
-    theme_files = get_templates()['files']
-    
-    # Find matching theme file
-    for f in theme_files:
-        if theme == Path(f).stem:
-            with open(f, 'r') as file:
-                theme_prompt = file.read()
-                break
-    else:
-        raise ValueError(f"Theme {theme!r} not found in the prompt_templates directory.")
+    try:
+        theme_prompt = theme_registry.get(theme).text
+    except KeyError:
+        raise ValueError(f"Theme {theme!r} not found in the prompt_templates directory.") from None
     
     # Merge theme and context
     return merge_template_prompt(theme_prompt, context)
@@ -0,0 +1,222 @@
+"""
+Load test of the image generation, against the stand-in providers of `fakeprovider`.
+
+    python -m gardenparty.benchmark --flow pipeline --concurrency 8 --requests 100
+
+Runs `--requests` generations, `--concurrency` at a time, and reports the latency percentiles of every stage and the
+throughput. The flows are:
+
+- `pipeline`: `describe_image`, `merge_template_prompt` and `image_to_image` called one after another
+- `generate`: the job of the Gradio UI, run by the job queue, with its stages
+- `gradio`: the `generate_image` handler of the Gradio UI, from the first update to the last
+
+Unless `--provider-url` is given, the stand-in is started in this process. Its latencies and failure rates are set with
+the `FAKE_PROVIDER_*` environment variables. Every generation uses a new drawing, so nothing comes from the caches,
+unless `--same-image` is given.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FLOWS = ('pipeline', 'generate', 'gradio')
+
+
+def start_fake_provider() -> str:
+    """Start the stand-in providers in a background thread, and return their URL."""
+    import uvicorn
+
+    from .fakeprovider import app
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="fake-provider", daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+def make_drawing(directory: Path, number: int) -> Path:
+    """Write a random drawing to `directory`, named by its content hash like the uploads of the UI."""
+    rng = np.random.default_rng(number)
+    image = np.full((1200, 900, 3), 255, dtype=np.uint8)
+    for _ in range(20):
+        start, end = rng.integers(0, 900, 2), rng.integers(0, 900, 2)
+        cv2.line(image, tuple(map(int, start)), tuple(map(int, end)), tuple(map(int, rng.integers(0, 255, 3))), 8)
+    data = cv2.imencode('.jpg', image)[1].tobytes()
+    path = directory / f"{hashlib.sha256(data).hexdigest()}.jpg"
+    path.write_bytes(data)
+    return path
+
+
+def run_pipeline(path: Path, theme: str) -> Dict[str, float]:
+    from . import backend
+
+    times = {}
+    start = time.perf_counter()
+    description = backend.describe_image(path.name)['reply']
+    times['describe'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prompt = backend.merge_template_prompt(backend.theme_registry.get(theme).text, description)
+    times['merge'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    backend.image_to_image(path.name, prompt['prompt'], prompt['negative_prompt'])
+    times['image'] = time.perf_counter() - start
+    return times
+
+
+def run_generate(path: Path, theme: str) -> Dict[str, float]:
+    from . import backend
+
+    start = time.perf_counter()
+    description = backend.describe_image(path.name)['reply']
+    job = backend.jobs.submit(backend.generate_job, path.name, theme, description)
+
+    # Time spent in each stage, from the stage changes seen while waiting
+    times = defaultdict(float)
+    times['describe'] = time.perf_counter() - start
+    stage, changed = 'queue', time.perf_counter()
+    version = job.version
+    while not job.done:
+        job.wait(version, timeout=60)
+        version = job.version
+        now = time.perf_counter()
+        if (job.stage or 'queue') != stage or job.done:
+            times[stage] += now - changed
+            stage, changed = job.stage or 'queue', now
+    if job.status == 'failed':
+        raise job.exception
+    return times
+
+
+def run_gradio(path: Path, theme: str) -> Dict[str, float]:
+    from . import backend, frontend
+
+    start = time.perf_counter()
+    description = backend.describe_image(path.name)['reply']
+    times = {'describe': time.perf_counter() - start}
+    start = time.perf_counter()
+    updates = frontend.generate_image([], str(path), description, theme)
+    for _ in updates:
+        times.setdefault('first_update', time.perf_counter() - start)
+    times['generate_image'] = time.perf_counter() - start
+    return times
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {'p50': p50, 'p95': p95, 'p99': p99, 'mean': float(np.mean(values)), 'max': max(values)}
+
+
+def run(flow: str, requests: int, concurrency: int, theme: str, same_image: bool) -> Dict:
+    from .app import settings
+
+    originals = Path(settings.INSTANCE_PATH) / 'original'
+    originals.mkdir(parents=True, exist_ok=True)
+    (Path(settings.INSTANCE_PATH) / 'generated').mkdir(parents=True, exist_ok=True)
+    drawings = [make_drawing(originals, 0 if same_image else number) for number in range(requests)]
+
+    func = {'pipeline': run_pipeline, 'generate': run_generate, 'gradio': run_gradio}[flow]
+    # Import the app modules before the clock starts
+    from . import backend  # noqa: F401
+    if flow == 'gradio':
+        from . import frontend  # noqa: F401
+    stages = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+
+    def one(path: Path) -> None:
+        start = time.perf_counter()
+        try:
+            times = func(path, theme)
+        except Exception as e:
+            logger.debug("Generation failed: %r", e)
+            with lock:
+                errors[type(e).__name__] += 1
+            return
+        with lock:
+            for stage, seconds in times.items():
+                stages[stage].append(seconds)
+            stages['total'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, drawings))
+    elapsed = time.perf_counter() - start
+
+    completed = len(stages['total'])
+    return {
+        'flow': flow,
+        'requests': requests,
+        'concurrency': concurrency,
+        'completed': completed,
+        'errors': dict(errors),
+        'seconds': elapsed,
+        'throughput': completed / elapsed,
+        'stages': {stage: percentiles(values) for stage, values in stages.items() if values},
+    }
+
+
+def print_report(report: Dict) -> None:
+    print(f"{report['flow']}: {report['completed']}/{report['requests']} completed at concurrency "
+          f"{report['concurrency']} in {report['seconds']:.1f} s, {report['throughput']:.2f} per second")
+    if report['errors']:
+        print("errors: " + ", ".join(f"{name} {count}" for name, count in sorted(report['errors'].items())))
+    print(f"{'stage':<16}{'p50':>9}{'p95':>9}{'p99':>9}{'mean':>9}{'max':>9}")
+    for stage, values in report['stages'].items():
+        print(f"{stage:<16}" + "".join(f"{values[key]:>9.3f}" for key in ('p50', 'p95', 'p99', 'mean', 'max')))
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Load test the image generation against stand-in providers")
+    parser.add_argument('--flow', choices=FLOWS, default='pipeline')
+    parser.add_argument('--requests', type=int, default=20, help="Number of generations")
+    parser.add_argument('--concurrency', type=int, default=4, help="Number of generations at the same time")
+    parser.add_argument('--theme', default='ei_teemaa')
+    parser.add_argument('--same-image', action='store_true', help="Generate from the same drawing every time")
+    parser.add_argument('--provider-url', help="URL of a running fakeprovider, instead of starting one")
+    parser.add_argument('--instance', help="Instance directory to use, instead of a temporary one")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    # The settings are read on import, so they are set before importing the app modules
+    os.environ['INSTANCE_PATH'] = args.instance or tempfile.mkdtemp(prefix="gardenparty-benchmark-")
+    url = args.provider_url or start_fake_provider()
+    os.environ['OPENAI_BASE_URL'] = f"{url}/v1"
+    os.environ['STABILITY_BASE_URL'] = url
+    # Never send the real keys anywhere from here
+    os.environ['OPENAI_API_KEY'] = "benchmark"
+    os.environ['STABILITYAI_API_KEY'] = "benchmark"
+
+    report = run(args.flow, args.requests, args.concurrency, args.theme, args.same_image)
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Two-tier cache of the results of calls to the AI services.
+
+Results are JSON values stored under a hex key, usually a digest of everything the result depends on. The most recently
+used results are kept in memory, and all of them on disk, one file per key, until the files grow over their disk budget
+and the least recently used ones are evicted. The disk tier is shared by all processes using the same directory.
+
+The disk tier is a `DiskLRU`, which also stores the image renditions.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_digests: Dict[Path, Tuple[int, int, str]] = {}
+
+
+def file_digest(path: Path) -> str:
+    """Return the SHA-256 of the file at `path`, cached until the file changes."""
+    path = Path(path)
+    stat = os.stat(path)
+    cached = _digests.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    with open(path, 'rb') as file:
+        digest = hashlib.file_digest(file, 'sha256').hexdigest()
+    _digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+def forget_digest(path: Path) -> None:
+    """Drop the cached SHA-256 of the file at `path`, so it is computed again on the next `file_digest()`."""
+    _digests.pop(Path(path), None)
+
+
+def cache_key(*parts: str) -> str:
+    """Return a key for the result of a call that depends on `parts`."""
+    digest = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class DiskLRU:
+    """
+    Files under `directory`, limited to `max_bytes`, the least recently used evicted first.
+
+    Files are named by the caller, and kept in subdirectories by the first two characters of their name. They are
+    written atomically, so concurrent readers, in this or another process, never see a partial file.
+    """
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    def path(self, name: str) -> Path:
+        return self.directory / name[:2] / name
+
+    def touch(self, name: str) -> bool:
+        """Mark file `name` as recently used. Returns False if there is no such file."""
+        try:
+            os.utime(self.path(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def read(self, name: str) -> bytes:
+        """Return the contents of file `name` and mark it as recently used. Raises `FileNotFoundError` if missing."""
+        path = self.path(name)
+        data = path.read_bytes()
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted meanwhile, the contents are still good
+            pass
+        return data
+
+    def write(self, name: str, data: bytes) -> Path:
+        """Store `data` as file `name`, replacing the previous contents, and return its path."""
+        path = self.path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.directory / f".{name}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            tmp.write_bytes(data)
+            try:
+                replaced = path.stat().st_size
+            except FileNotFoundError:
+                replaced = 0
+            os.replace(tmp, path)
+        finally:
+            tmp.unlink(missing_ok=True)
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._disk_usage()
+            else:
+                self._total_bytes += len(data) - replaced
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+        return path
+
+    def _files(self) -> List[Tuple[float, int, Path]]:
+        # (mtime, size, path) of the stored files, skipping the ones removed by another process meanwhile
+        files = []
+        for path in self.directory.glob('*/*'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _disk_usage(self) -> int:
+        return sum(size for _mtime, size, _path in self._files())
+
+    def evict(self) -> None:
+        """Remove the least recently used files until the total is 10% under the budget."""
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _mtime, size, _path in files)
+            target = self.max_bytes * 0.9
+            removed = 0
+            for _mtime, size, path in files:
+                if total <= target:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                removed += 1
+            self._total_bytes = total
+        logger.info("Evicted %d files from %s, %d bytes remain", removed, self.directory, total)
+
+
+class ResultCache:
+    """
+    Results kept in memory (at most `max_items`) and on disk under `directory` (at most `max_bytes`).
+    """
+
+    def __init__(self, directory: Path, max_bytes: int = 64 * 1024 * 1024, max_items: int = 1024):
+        self.directory = Path(directory)
+        self.max_items = max_items
+        self.files = DiskLRU(directory, max_bytes)
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> Path:
+        return self.files.path(f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the result stored under `key`, or None if there is none."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return self._memory[key]
+
+        try:
+            value = json.loads(self.files.read(f"{key}.json"))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except ValueError:
+            logger.warning("Ignoring unreadable cached result %s", self.path(key))
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._remember(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Store the JSON-serializable `value` under `key`."""
+        self._remember(key, value)
+        self.files.write(f"{key}.json", json.dumps(value).encode())
+
+    def _remember(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
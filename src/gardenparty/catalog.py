@@ -0,0 +1,333 @@
+"""
+In-memory catalog of the images in a directory.
+
+Listing the generated images and stat'ing every file on every request gets slow once the gallery fills up. The catalog
+keeps the listing and timestamps in memory, and refreshes only what changed: on Linux the directory is watched with
+inotify, elsewhere the directory mtime is polled, with a periodic full rescan to catch files rewritten in place.
+
+`FilteredCatalog` narrows a catalog down to the images that pass a filter, such as the moderation status, updating
+only the images whose file or filter result changed.
+"""
+import bisect
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class ImageInfo(NamedTuple):
+    name: str
+    ctime: float
+    mtime: float
+    mtime_ns: int
+
+
+class Snapshot:
+    """
+    Immutable view of the catalog at one point in time.
+    """
+
+    def __init__(self, version: int, images: Iterable[ImageInfo]):
+        self.version = version
+        self.by_name: Dict[str, ImageInfo] = {image.name: image for image in images}
+
+        # Newest first by modification time, ties broken by name
+        self.images: List[ImageInfo] = sorted(self.by_name.values(), key=lambda i: (i.mtime_ns, i.name), reverse=True)
+
+        # Oldest first by creation time, for finding the images older than some age
+        by_ctime = sorted(self.by_name.values(), key=lambda i: (i.ctime, i.name))
+        self.created_names: List[str] = [image.name for image in by_ctime]
+        self.ctimes = np.array([image.ctime for image in by_ctime], dtype=np.float64)
+
+        self._etag: Optional[str] = None
+        self._ascending_keys: Optional[List[Tuple[int, str]]] = None
+
+    def __len__(self) -> int:
+        return len(self.images)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.by_name
+
+    @property
+    def etag(self) -> str:
+        """Digest of the image names and modification times, equal across processes for the same directory state."""
+        if self._etag is None:
+            digest = hashlib.blake2b(digest_size=16)
+            for image in self.images:
+                digest.update(f"{image.name}:{image.mtime_ns}\n".encode())
+            self._etag = digest.hexdigest()
+        return self._etag
+
+    def page(self, after: Optional[Tuple[int, str]] = None, limit: int = 50) -> List[ImageInfo]:
+        """
+        Return at most `limit` images, newest first, starting after the (mtime_ns, name) key `after`.
+
+        Images added after the first page was fetched sort before `after`, so they don't shift the later pages.
+        """
+        start = 0
+        if after is not None:
+            if self._ascending_keys is None:
+                self._ascending_keys = [(image.mtime_ns, image.name) for image in reversed(self.images)]
+            start = len(self.images) - bisect.bisect_left(self._ascending_keys, tuple(after))
+        return self.images[start:start + limit]
+
+    def created_before(self, timestamp: float) -> int:
+        """Return how many of the images in `created_names` were created before `timestamp`."""
+        return int(np.searchsorted(self.ctimes, timestamp, side='left'))
+
+
+class ImageCatalog:
+    """
+    Cached listing of the files in `directory`.
+    """
+
+    def __init__(self, directory: Path, poll_interval: float = 1.0, rescan_interval: float = 30.0):
+        self.directory = Path(directory)
+        self.poll_interval = poll_interval
+        self.rescan_interval = rescan_interval
+
+        self._lock = threading.Lock()
+        self._snapshot = Snapshot(0, [])
+        self._inotify_fd: Optional[int] = None
+        self._dir_mtime_ns = 0
+        self._last_poll = 0.0
+        self._last_rescan = 0.0
+        self._listeners = []
+
+    def open(self) -> None:
+        """Scan the directory, and start watching it for changes if inotify is available."""
+        self._inotify_fd = self._watch()
+        with self._lock:
+            self._rescan()
+
+    def close(self) -> None:
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
+
+    def add_listener(self, listener: Callable[[Snapshot, Set[str]], None]) -> None:
+        """Call `listener(snapshot, changed_names)` whenever the catalog changes."""
+        self._listeners.append(listener)
+
+    def _watch(self) -> Optional[int]:
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+            if libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK) < 0:
+                os.close(fd)
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        except (OSError, AttributeError, TypeError) as e:
+            logger.info("Watching %s with inotify is not available (%s), polling instead", self.directory, e)
+            return None
+        return fd
+
+    def snapshot(self) -> Snapshot:
+        """Return the current state of the catalog, refreshing it first if the directory has changed."""
+        self.refresh()
+        return self._snapshot
+
+    def refresh(self) -> None:
+        """Apply the changes made to the directory since the last refresh."""
+        if self._inotify_fd is not None:
+            changed = self._read_events()
+            if changed:
+                with self._lock:
+                    if None in changed:
+                        self._rescan()
+                    else:
+                        self._update(changed)
+            return
+
+        now = time.monotonic()
+        if now - self._last_poll < self.poll_interval:
+            return
+        with self._lock:
+            self._last_poll = now
+            if now - self._last_rescan >= self.rescan_interval:
+                self._rescan()
+                return
+            try:
+                dir_mtime_ns = os.stat(self.directory).st_mtime_ns
+            except FileNotFoundError:
+                dir_mtime_ns = 0
+            if dir_mtime_ns != self._dir_mtime_ns:
+                self._dir_mtime_ns = dir_mtime_ns
+                names = set(os.listdir(self.directory))
+                known = set(self._snapshot.by_name)
+                self._update(names ^ known)
+
+    def _read_events(self) -> set:
+        """Return the names of the files changed according to inotify, with None meaning a full rescan is needed."""
+        changed = set()
+        while True:
+            try:
+                data = os.read(self._inotify_fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset < len(data):
+                _wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & (IN_Q_OVERFLOW | IN_DELETE_SELF) or not name:
+                    changed.add(None)
+                else:
+                    changed.add(os.fsdecode(name))
+
+    def _stat(self, name: str) -> Optional[ImageInfo]:
+        try:
+            stat = os.stat(self.directory / name)
+        except FileNotFoundError:
+            return None
+        return ImageInfo(name, stat.st_ctime, stat.st_mtime, stat.st_mtime_ns)
+
+    def _rescan(self) -> None:
+        images = []
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    images.append(ImageInfo(entry.name, stat.st_ctime, stat.st_mtime, stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+        self._last_rescan = time.monotonic()
+
+        old = self._snapshot.by_name
+        new = {image.name: image for image in images}
+        changed = {name for name in old.keys() | new.keys() if old.get(name) != new.get(name)}
+        if changed or not self._snapshot.version:
+            self._publish(images, changed)
+
+    def _update(self, names: Iterable[str]) -> None:
+        images = dict(self._snapshot.by_name)
+        changed = set()
+        for name in names:
+            image = self._stat(name)
+            if image == images.get(name):
+                continue
+            changed.add(name)
+            if image is None:
+                images.pop(name, None)
+            else:
+                images[name] = image
+        if changed:
+            self._publish(images.values(), changed)
+
+    def _publish(self, images: Iterable[ImageInfo], changed: set) -> None:
+        self._snapshot = snapshot = Snapshot(self._snapshot.version + 1, images)
+        logger.debug("Image catalog of %s changed: %d images, %d changed", self.directory, len(snapshot), len(changed))
+        for listener in self._listeners:
+            try:
+                listener(snapshot, changed)
+            except Exception:
+                logger.exception("Image catalog listener failed")
+
+
+class FilteredCatalog:
+    """
+    View of an `ImageCatalog` with only the images for which `include(name)` is true.
+
+    `refresh_filter()` is called on every refresh, and returns the names of the images whose filter result may have
+    changed since the previous call.
+    """
+
+    def __init__(self, catalog: ImageCatalog, include: Callable[[str], bool],
+                 refresh_filter: Optional[Callable[[], Iterable[str]]] = None):
+        self.catalog = catalog
+        self.include = include
+        self.refresh_filter = refresh_filter
+
+        self._lock = threading.Lock()
+        self._source = Snapshot(0, [])
+        self._snapshot = Snapshot(0, [])
+        self._listeners = []
+        catalog.add_listener(self._on_change)
+
+    def open(self) -> None:
+        self.catalog.open()
+
+    def close(self) -> None:
+        self.catalog.close()
+
+    def add_listener(self, listener: Callable[[Snapshot, Set[str]], None]) -> None:
+        """Call `listener(snapshot, changed_names)` whenever the filtered catalog changes."""
+        self._listeners.append(listener)
+
+    def snapshot(self) -> Snapshot:
+        """Return the current state of the filtered catalog, refreshing it first."""
+        self.refresh()
+        return self._snapshot
+
+    def refresh(self) -> None:
+        """Apply the changes made to the directory, and to the filter, since the last refresh."""
+        self.catalog.refresh()
+        if self.refresh_filter is not None:
+            changed = set(self.refresh_filter())
+            if changed:
+                self.invalidate(changed)
+
+    def invalidate(self, names: Iterable[str]) -> None:
+        """Apply the filter again to `names`, after their filter result has changed."""
+        with self._lock:
+            self._filter(self._source, set(names))
+
+    def _on_change(self, source: Snapshot, changed: Set[str]) -> None:
+        with self._lock:
+            self._source = source
+            self._filter(source, changed)
+
+    def _filter(self, source: Snapshot, names: Set[str]) -> None:
+        current = self._snapshot.by_name
+        images = dict(current)
+        changed = set()
+        for name in names:
+            image = source.by_name.get(name)
+            if image is None or not self.include(name):
+                image = None
+            if image == current.get(name):
+                continue
+            changed.add(name)
+            if image is None:
+                images.pop(name, None)
+            else:
+                images[name] = image
+        if changed or not self._snapshot.version:
+            self._publish(images.values(), changed)
+
+    def _publish(self, images: Iterable[ImageInfo], changed: Set[str]) -> None:
+        self._snapshot = snapshot = Snapshot(self._snapshot.version + 1, images)
+        for listener in self._listeners:
+            try:
+                listener(snapshot, changed)
+            except Exception:
+                logger.exception("Image catalog listener failed")
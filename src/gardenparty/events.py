@@ -0,0 +1,76 @@
+"""
+Server-Sent Events feeds for the display pages.
+
+A feed computes its next event once per tick, and pushes the same event to every connected display. N screens cost
+one computation per tick instead of N polling requests.
+"""
+import asyncio
+import json
+import logging
+from typing import AsyncIterator, Callable, Optional, Set
+
+from starlette.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+# Seconds of silence after which a comment is sent to keep proxies from closing the connection
+KEEPALIVE_INTERVAL = 15.0
+
+
+class Feed:
+    """
+    Event feed shared by all subscribers.
+
+    `produce()` is called every `interval` seconds while anyone is subscribed, and its result is sent as the data of an
+    event named `name`. With `only_changes`, an event is only sent when the result differs from the previous one.
+    `produce()` may return None to skip a tick.
+    """
+
+    def __init__(self, name: str, produce: Callable[[], Optional[dict]], interval: float, only_changes: bool = False):
+        self.name = name
+        self.produce = produce
+        self.interval = interval
+        self.only_changes = only_changes
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._task: Optional[asyncio.Task] = None
+        self._last: Optional[str] = None
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        """Yield the events of the feed as Server-Sent Events messages."""
+        queue = asyncio.Queue(maxsize=1)
+        self._subscribers.add(queue)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        try:
+            # Show the latest event right away instead of waiting for the next tick
+            if self._last is not None:
+                yield self._last
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            self._subscribers.discard(queue)
+
+    async def _run(self) -> None:
+        while self._subscribers:
+            try:
+                data = await run_in_threadpool(self.produce)
+            except Exception:
+                logger.exception("Failed to produce a %s event", self.name)
+                data = None
+
+            if data is not None:
+                message = f"event: {self.name}\ndata: {json.dumps(data)}\n\n"
+                if not (self.only_changes and message == self._last):
+                    self._last = message
+                    self._publish(message)
+            await asyncio.sleep(self.interval)
+
+    def _publish(self, message: str) -> None:
+        for queue in self._subscribers:
+            # Slow subscribers only get the newest event
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(message)
@@ -0,0 +1,179 @@
+"""
+Stand-in for the OpenAI and Stability AI APIs, for load testing the generation without paying for or being throttled
+by the real services.
+
+Serves the parts of the chat completions and `v2beta/stable-image/generate/sd3` APIs that the backend uses, with
+random latencies and failures. Run it with `uvicorn gardenparty.fakeprovider:app --port 8001`, and point the backend at
+it with `OPENAI_BASE_URL=http://localhost:8001/v1` and `STABILITY_BASE_URL=http://localhost:8001`. The latencies and
+failure rates are set with the `FAKE_PROVIDER_*` environment variables of `FakeProviderSettings`.
+"""
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+import uuid
+from functools import lru_cache
+
+import cv2
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import Field
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class FakeProviderSettings(BaseSettings):
+    CHAT_LATENCY: float = Field(1.5, help="Median seconds of a chat completion")
+    CHAT_LATENCY_SPREAD: float = Field(0.5, help="Standard deviation of the log of the chat completion latency")
+    IMAGE_LATENCY: float = Field(6.0, help="Median seconds of an image generation")
+    IMAGE_LATENCY_SPREAD: float = Field(0.3, help="Standard deviation of the log of the image generation latency")
+    ERROR_RATE: float = Field(0.0, help="Fraction of the calls failing with 500")
+    RATE_LIMIT_RATE: float = Field(0.0, help="Fraction of the calls refused with 429, on top of the rate limits")
+    MODERATION_RATE: float = Field(0.0, help="Fraction of the image generations refused by content moderation")
+    OPENAI_REQUESTS_PER_MINUTE: float = Field(0, help="Chat completions allowed per minute, 0 for no limit")
+    STABILITY_REQUESTS_PER_MINUTE: float = Field(0, help="Image generations allowed per minute, 0 for no limit")
+    RETRY_AFTER: float = Field(1.0, help="Seconds told to wait in the Retry-After header of 429 responses")
+    IMAGE_SIZE: int = Field(1024, help="Width and height of the generated images")
+
+    model_config = SettingsConfigDict(env_prefix="FAKE_PROVIDER_")
+
+
+fake_settings = FakeProviderSettings()
+
+app = FastAPI()
+
+
+def _bucket(per_minute: float):
+    # A burst of ten seconds of calls, as the real limits allow
+    return TokenBucket(per_minute / 60, max(1.0, per_minute / 6)) if per_minute > 0 else None
+
+
+buckets = {
+    'openai': _bucket(fake_settings.OPENAI_REQUESTS_PER_MINUTE),
+    'stability': _bucket(fake_settings.STABILITY_REQUESTS_PER_MINUTE),
+}
+
+FAKE_MERGE_REPLY = """Here is the prompt:
+```json
+{"prompt": "A colourful drawing of a garden party, %s", "negative_prompt": "blurry, text"}
+```"""
+
+
+def latency(median: float, spread: float) -> float:
+    """Return a random latency from the log-normal distribution of `median` and log standard deviation `spread`."""
+    return median * math.exp(random.gauss(0, spread)) if spread > 0 else median
+
+
+@lru_cache(maxsize=4)
+def fake_image(size: int) -> bytes:
+    """Return a JPEG of noise, compressing about as badly as a real generated image."""
+    rng = np.random.default_rng(0)
+    image = cv2.resize(rng.integers(0, 256, (size // 8, size // 8, 3), dtype=np.uint8), (size, size))
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def unique_image(size: int) -> bytes:
+    """Return the fake image with a random JPEG comment, so every generated image has a different content hash."""
+    data = fake_image(size)
+    comment = uuid.uuid4().hex.encode()
+    # The comment segment goes right after the start of image marker
+    return data[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, 'big') + comment + data[2:]
+
+
+def throttled(provider: str):
+    """Return a 429 response if the call is over the rate limit, or None if it goes through."""
+    bucket = buckets[provider]
+    if (bucket is not None and not bucket.try_acquire()) or random.random() < fake_settings.RATE_LIMIT_RATE:
+        headers = {"Retry-After": str(fake_settings.RETRY_AFTER)}
+        if provider == 'openai':
+            body = {'error': {'message': "Rate limit reached", 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+        else:
+            body = {'name': 'rate_limit_exceeded', 'errors': ["You have exceeded the rate limit"]}
+        return JSONResponse(body, status_code=429, headers=headers)
+    return None
+
+
+def failure(provider: str):
+    """Return a 500 response if the call fails, or None if it succeeds."""
+    if random.random() < fake_settings.ERROR_RATE:
+        if provider == 'openai':
+            body = {'error': {'message': "The server had an error", 'type': 'server_error', 'code': None}}
+        else:
+            body = {'name': 'internal_error', 'errors': ["An unexpected server error occurred"]}
+        return JSONResponse(body, status_code=500)
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """Reply with a description of an image, or a merged prompt when the prompt asks for one."""
+    body = await request.json()
+    # Rate limited calls are refused right away, failures take their time
+    refused = throttled('openai')
+    if refused is not None:
+        return refused
+
+    text = str(body['messages'][-1]['content'])
+    token = uuid.uuid4().hex[:8]
+    if 'negative_prompt' in text:
+        content = FAKE_MERGE_REPLY % token
+    else:
+        content = f"A stick figure holding a balloon next to a tree, drawing {token}."
+
+    seconds = latency(fake_settings.CHAT_LATENCY, fake_settings.CHAT_LATENCY_SPREAD)
+    if body.get('stream'):
+        return StreamingResponse(stream_completion(content, body, seconds), media_type="text/event-stream")
+    await asyncio.sleep(seconds)
+    refused = failure('openai')
+    if refused is not None:
+        return refused
+    return {
+        'id': f"chatcmpl-{token}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'gpt-4o-mini'),
+        'choices': [
+            {'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': content}},
+        ],
+        'usage': {'prompt_tokens': 100, 'completion_tokens': 60, 'total_tokens': 160},
+    }
+
+
+async def stream_completion(content: str, body: dict, seconds: float):
+    """Yield the completion as server-sent events, the first word after a fifth of `seconds` and the rest evenly."""
+    words = content.split(" ")
+    chunk = {'id': f"chatcmpl-{uuid.uuid4().hex[:8]}", 'object': 'chat.completion.chunk', 'created': int(time.time()),
+             'model': body.get('model', 'gpt-4o-mini')}
+    await asyncio.sleep(seconds / 5)
+    for number, word in enumerate(words):
+        delta = {'content': word if number == 0 else " " + word}
+        yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]})}\n\n"
+        await asyncio.sleep(seconds * 4 / 5 / len(words))
+    yield f"data: {json.dumps({**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v2beta/stable-image/generate/sd3")
+async def generate_sd3(request: Request):
+    """Respond with an image, as `image_to_image` asks for."""
+    form = await request.form()
+    if 'image' not in form or 'prompt' not in form:
+        return JSONResponse({'name': 'bad_request', 'errors': ["image and prompt are required"]}, status_code=400)
+    refused = throttled('stability')
+    if refused is not None:
+        return refused
+    await asyncio.sleep(latency(fake_settings.IMAGE_LATENCY, fake_settings.IMAGE_LATENCY_SPREAD))
+    refused = failure('stability')
+    if refused is not None:
+        return refused
+    if random.random() < fake_settings.MODERATION_RATE:
+        body = {'name': 'content_moderation', 'errors': ["Your request was flagged by our content moderation system"]}
+        return JSONResponse(body, status_code=403)
+    headers = {'seed': str(form.get('seed', 0)), 'finish-reason': 'SUCCESS'}
+    return Response(unique_image(fake_settings.IMAGE_SIZE), media_type="image/jpeg", headers=headers)
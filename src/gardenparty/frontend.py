@@ -15,7 +15,9 @@ import os
 
 import requests
 
-from gardenparty.backend import describe_image, generate_themed_prompt, get_templates, image_to_image
+from gardenparty.backend import describe_image, generate_job, generation_key, jobs, stream_description, theme_registry
+from gardenparty.jobs import QueueFull
+from gardenparty.providers import ContentRejected
 from gardenparty.preprocess import autocrop, autocrop_and_straighten
 
 from gardenparty.app import settings
@@ -27,6 +29,9 @@ os.environ.setdefault("GRADIO_TELEMETRY", "0")
 os.environ.setdefault('GRADIO_ANALYTICS_ENABLED', "0")
 os.environ.setdefault("GRADIO_SERVER_NAME", "0.0.0.0")
 
+# Seconds between the updates of the description textbox while the description streams in
+STREAM_UPDATE_INTERVAL = 0.1
+
 DESCRIPTION = r"""
 ## Tutkijoiden yö: Tekoälypiirros
 
@@ -103,9 +108,7 @@ def get_sketch_description(image) -> str:
     return r["reply"]
 
 def get_image_themes():
-    return [
-        Path(f).stem for f in get_templates()["files"]
-    ]
+    return theme_registry.names()
 
 def save_email(img, email):
     """
@@ -147,7 +150,14 @@ def add_image_description(img_input, chat_history):
 
         yield ui_chatbot(chat_history),  "..."
 
-        description = get_sketch_description(fname)
+        # Show the description as it is written, at most every STREAM_UPDATE_INTERVAL seconds
+        description = ""
+        last_update = time.monotonic()
+        for piece in stream_description(fname):
+            description += piece
+            if time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL:
+                last_update = time.monotonic()
+                yield ui_chatbot(chat_history), description
         # description = "ASDF"
 
         # chat_history += [
@@ -209,30 +219,38 @@ def generate_image(chat_history, img_input, prompt, theme):
 
         yield ui_chatbot(chat_history)
 
-        generative_prompt = generate_themed_prompt(theme, prompt)
-        
-        positive = generative_prompt["prompt"]
-        negative = generative_prompt["negative_prompt"]
-
-        img2img = image_to_image(fname, positive, negative)
-
-        chat_history += [
-            ChatMessage(
-                role="assistant",
-                content=f"Generoidaan kuvaa, vaihe 2/2 ⚙️  ..."
-            )
-        ]
-
-        yield ui_chatbot(chat_history)
-
-        description2 = get_sketch_description(img2img['output_filename'])
-
-        generative_prompt = generate_themed_prompt(theme, description2)
-        
-        positive = generative_prompt["prompt"]
-        negative = generative_prompt["negative_prompt"]
-
-        img2img = image_to_image(fname, positive, negative)
+        # The generation runs in the job queue, which limits how many run at the same time
+        try:
+            # A double click follows the job of the first click
+            job = jobs.submit_once(generation_key(fname, theme, prompt), generate_job, fname, theme, prompt)
+        except QueueFull:
+            chat_history += [
+                ChatMessage(
+                    role="assistant",
+                    content="Kuvia generoidaan juuri nyt paljon. Yritä hetken päästä uudelleen 🙏"
+                )
+            ]
+            yield ui_chatbot(chat_history)
+            return
+
+        version = job.version
+        shown_step2 = False
+        while not job.done:
+            job.wait(version, timeout=15)
+            version = job.version
+            if job.stage in ('refine_prompt', 'refine_image') and not shown_step2:
+                shown_step2 = True
+                chat_history += [
+                    ChatMessage(
+                        role="assistant",
+                        content=f"Generoidaan kuvaa, vaihe 2/2 ⚙️  ..."
+                    )
+                ]
+                yield ui_chatbot(chat_history)
+
+        if job.status == 'failed':
+            raise job.exception
+        img2img = job.result
     
         chat_history += [
             ChatMessage(
@@ -269,7 +287,17 @@ def generate_image(chat_history, img_input, prompt, theme):
         # )]
 
         yield ui_chatbot(chat_history)
-        
+
+    except ContentRejected:
+        chat_history += [
+            ChatMessage(
+                role="assistant",
+                content="Kuvapalvelu hylkäsi kuvauksen sisällön. Muokkaa kuvausta ja yritä uudelleen.",
+            )
+        ]
+        yield ui_chatbot(chat_history)
+        return
+
     except Exception as e:
         chat_history += [
             ChatMessage(
@@ -0,0 +1,215 @@
+"""
+Background jobs for the image generations.
+
+A generation chains several slow calls to the AI services. Instead of running the chain in the request handler, it is
+submitted as a job and run by a fixed pool of worker threads, while the client polls or streams the job status. The
+queue of waiting jobs is bounded, so a rush of users gets a "try again later" instead of piling up work, and
+`ProviderLimits` caps the number of concurrent calls to each service provider.
+"""
+import itertools
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, Literal, Optional
+
+logger = logging.getLogger(__name__)
+
+JobStatus = Literal['queued', 'running', 'done', 'failed']
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is full."""
+
+
+class Job:
+    """
+    A function call run by a `JobQueue`, and its status.
+
+    The function gets the job as its first argument, and can report its progress with `set_stage()`.
+    """
+
+    def __init__(self, func: Callable[..., Any], args: tuple, kwargs: dict):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.status: JobStatus = 'queued'
+        self.stage: Optional[str] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.exception: Optional[BaseException] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        # Incremented on every change, for waiting on the next one
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def _update(self, **changes) -> None:
+        with self._changed:
+            for name, value in changes.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def set_stage(self, stage: str) -> None:
+        """Report the step the job is at, for showing progress to the user."""
+        self._update(stage=stage)
+
+    def wait(self, version: Optional[int] = None, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the job has changed since `version`, or until it is finished if `version` is None.
+
+        Returns False if `timeout` seconds passed first.
+        """
+        with self._changed:
+            if version is None:
+                return self._changed.wait_for(lambda: self.done, timeout)
+            return self._changed.wait_for(lambda: self.version != version or self.done, timeout)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on `workers` threads, with at most `max_queued` jobs waiting.
+
+    Finished jobs are kept for `retention` seconds, so their results can still be fetched.
+    """
+
+    def __init__(self, workers: int = 4, max_queued: int = 32, retention: float = 3600):
+        self.workers = workers
+        self.retention = retention
+        self._queue: "queue.Queue[Optional[Job]]" = queue.Queue(maxsize=max_queued)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # Unfinished jobs submitted with a key
+        self._keyed: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self) -> None:
+        """Start the workers. Called by the first `submit()` if not called before."""
+        with self._lock:
+            self._start()
+
+    def _start(self) -> None:
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Stop the workers after the running jobs. Jobs still in the queue fail without being run."""
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                job._update(status='failed', error="Shutting down", exception=RuntimeError("Shutting down"),
+                            finished=time.time())
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, func: Callable[..., Any], *args, **kwargs) -> Job:
+        """Queue the call `func(job, *args, **kwargs)`. Raises `QueueFull` if too many jobs are waiting."""
+        with self._lock:
+            return self._submit(Job(func, args, kwargs))
+
+    def submit_once(self, key: str, func: Callable[..., Any], *args, **kwargs) -> Job:
+        """Like `submit()`, but return the unfinished job submitted with the same `key` if there is one."""
+        with self._lock:
+            job = self._keyed.get(key)
+            if job is None or job.done:
+                job = self._keyed[key] = self._submit(Job(func, args, kwargs))
+            return job
+
+    def _submit(self, job: Job) -> Job:
+        self._start()
+        self._purge()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            raise QueueFull(f"{self._queue.maxsize} jobs are already waiting") from None
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def queued(self) -> int:
+        return self._queue.qsize()
+
+    def position(self, job: Job) -> int:
+        """Return the number of jobs queued before `job`, or 0 if it is not queued."""
+        if job.status != 'queued':
+            return 0
+        with self._lock:
+            return sum(1 for other in itertools.takewhile(lambda j: j is not job, self._jobs.values())
+                       if other.status == 'queued')
+
+    def _purge(self) -> None:
+        for key, job in list(self._keyed.items()):
+            if job.done:
+                del self._keyed[key]
+
+        # Jobs are in submission order, so the ones that have been finished for longest are near the front
+        limit = time.time() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            if job.created >= limit:
+                break
+            if job.done and job.finished < limit:
+                del self._jobs[job_id]
+
+    def _work(self) -> None:
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job._update(status='running', started=time.time())
+            try:
+                result = job.func(job, *job.args, **job.kwargs)
+            except Exception as e:
+                logger.exception("Job %s failed", job.id)
+                job._update(status='failed', error=str(e) or type(e).__name__, exception=e, finished=time.time())
+            else:
+                job._update(status='done', result=result, finished=time.time())
+
+
+class ProviderLimits:
+    """
+    Caps the number of concurrent calls to each service provider, across all jobs and requests of the process.
+    """
+
+    def __init__(self, limits: Dict[str, int]):
+        self._semaphores = {provider: threading.BoundedSemaphore(limit) for provider, limit in limits.items()}
+
+    @contextmanager
+    def acquire(self, provider: str) -> Iterator[None]:
+        """Wait for a free call slot of `provider`, and hold it for the block."""
+        semaphore = self._semaphores[provider]
+        with semaphore:
+            yield
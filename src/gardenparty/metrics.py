@@ -0,0 +1,247 @@
+"""
+Counters and latency histograms, exposed in the Prometheus text format.
+
+Metrics are kept in the memory of each process, and `/metrics` of an app built by `create_app()` reports the ones of
+the process serving the request. Updating a metric takes a dictionary lookup and an uncontended lock, a few
+microseconds at most, so the request handlers can update them freely.
+"""
+import bisect
+import functools
+import inspect
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Upper bounds of the histogram buckets, in seconds
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+EXTERNAL_CALL_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# All metrics of the process by name
+REGISTRY: Dict[str, "Metric"] = {}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric(ABC):
+    """
+    Base class of the metrics, with the values of each combination of label values.
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        if name in REGISTRY:
+            raise ValueError(f"Metric {name!r} is already registered")
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY[name] = self
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"Metric {self.name!r} takes the labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _label_text(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        """Return the sample lines of the metric in the text format."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {_escape(self.help)}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self.samples())
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """
+    Value that only goes up, such as the number of votes.
+    """
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._label_text(key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values, such as request latencies, counted in buckets.
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = REQUEST_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                # Count of each bucket (not cumulative, the last one is +Inf), sum of the values
+                values = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            values[0][index] += 1
+            values[1] += value
+
+    def time(self, **labels: str) -> "Timer":
+        """Return a context manager, also usable as a decorator, that observes the seconds its block takes."""
+        return Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, list(counts), total) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{self._label_text(key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_text(key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{self._label_text(key)} {cumulative}")
+        return lines
+
+
+class Timer:
+    """
+    Observes the seconds taken by a block, or by every call of a decorated function, in a histogram.
+    """
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self.histogram = histogram
+        self.labels = labels
+        self._start: Optional[float] = None
+
+    def __enter__(self) -> "Timer":
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self._start, **self.labels)
+
+    def __call__(self, func: Callable) -> Callable:
+        histogram, labels = self.histogram, self.labels
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+
+
+def render() -> str:
+    """Return all metrics in the Prometheus text exposition format."""
+    return "".join(metric.render() for metric in REGISTRY.values())
+
+
+# Metrics shared by the apps
+REQUEST_SECONDS = Histogram(
+    "gardenparty_request_duration_seconds", "Time taken to start the responses to HTTP requests",
+    labels=("method", "route", "status"),
+)
+EXTERNAL_CALL_SECONDS = Histogram(
+    "gardenparty_external_call_duration_seconds", "Time taken by calls to the AI services", labels=("call",),
+    buckets=EXTERNAL_CALL_BUCKETS,
+)
+PREPROCESS_SECONDS = Histogram(
+    "gardenparty_preprocess_duration_seconds", "Time taken by the stages of preprocessing scanned drawings",
+    labels=("stage",),
+)
+PAGE_VIEWS = Counter("gardenparty_page_views_total", "Pages served", labels=("page",))
+VOTES = Counter("gardenparty_votes_total", "Votes received", labels=("result",))
+GENERATIONS = Counter("gardenparty_generations_total", "Image generation requests", labels=("result",))
+CACHE_LOOKUPS = Counter("gardenparty_cache_lookups_total", "Lookups of cached results", labels=("cache", "result"))
+COALESCED_CALLS = Counter(
+    "gardenparty_coalesced_calls_total", "Calls that shared the result of an identical call in flight", labels=("call",)
+)
+PROVIDER_RETRIES = Counter(
+    "gardenparty_provider_retries_total", "Calls to the AI services retried after a failure",
+    labels=("provider", "error"),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware observing the latency of every HTTP request, labelled by the route that served it.
+
+    Routes are labelled by their path template, and mounted apps by their mount point, so the number of label values
+    stays bounded whatever paths are requested. The latency is measured until the response starts, so the event streams
+    and other long-lived responses don't count the minutes they stay open.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        root_path = scope.get("root_path", "")
+        status = 500
+        seconds = None
+
+        async def send_with_status(message):
+            nonlocal status, seconds
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                seconds = time.perf_counter() - start
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router adds the matched route, or the root path of the mounted app, to the scope
+            route = scope.get("route")
+            if route is not None:
+                path = route.path
+            elif scope.get("root_path", "") != root_path:
+                path = scope["root_path"] + "/{path}"
+            else:
+                path = "unmatched"
+            if seconds is None:
+                seconds = time.perf_counter() - start
+            REQUEST_SECONDS.observe(seconds, method=scope["method"], route=path, status=status)
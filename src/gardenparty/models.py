@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -17,6 +17,63 @@ class Vote(BaseModel):
 
 class Settings(BaseSettings):
     INSTANCE_PATH: Path = Field(Path("./instance"), help="Directory to store instance data")
+    VOTE_LOG_DURABILITY: Literal["off", "normal", "full"] = Field(
+        "normal", help="Vote log durability: 'off' doesn't wait for commits, 'full' also fsyncs every batch"
+    )
+    VOTE_TOKEN_BACKEND: Literal["memory", "sqlite"] = Field(
+        "memory", help="Where vote tokens are stored. Use 'sqlite' when running more than one voting worker"
+    )
+    VOTE_TOKEN_TTL: float = Field(600.0, help="Seconds a vote token stays valid")
+    VOTE_TOKEN_MAX: int = Field(100_000, help="Maximum number of live vote tokens, oldest are dropped first")
+    RENDITION_CACHE_BYTES: int = Field(512 * 1024 * 1024, help="Disk budget of the resized image renditions")
+    RATING_K_FACTOR: float = Field(24.0, help="Elo K-factor used when updating image ratings after a vote")
+    VOTE_SNAPSHOT_INTERVAL: int = Field(
+        10_000, help="Number of new votes after which the vote state is snapshotted for fast startup, 0 to disable"
+    )
+    MODERATION_REQUIRED: bool = Field(
+        False, help="Only show images accepted by a moderator, instead of all images that have not been rejected"
+    )
+    MODERATION_TOKEN: str = Field(
+        "", help="Bearer token required by the moderation endpoints, which are disabled while it is empty"
+    )
+    PAIR_RECENCY_HALF_LIFE: float = Field(
+        3600.0, help="Seconds after which an image is half as likely to be shown on the displays, 0 to pick uniformly"
+    )
+    OPENAI_BASE_URL: str = Field("https://api.openai.com/v1", help="OpenAI API, or a stand-in")
+    STABILITY_BASE_URL: str = Field("https://api.stability.ai", help="Stability AI API, or a stand-in")
+    PROVIDER_TIMEOUT: float = Field(120.0, help="Seconds to wait for a response from the AI service providers")
+    PROVIDER_CONNECT_TIMEOUT: float = Field(10.0, help="Seconds to wait for a connection to the AI service providers")
+    PROVIDER_MAX_CONNECTIONS: int = Field(20, help="Maximum number of open connections to each AI service provider")
+    PROVIDER_KEEPALIVE: float = Field(120.0, help="Seconds an idle provider connection is kept open for reuse")
+    DESCRIBE_IMAGE_SIZE: int = Field(512, help="Longest side in pixels of the images uploaded to be described")
+    DESCRIBE_IMAGE_DETAIL: Literal["low", "high", "auto"] = Field(
+        "low", help="Detail at which OpenAI looks at the images to describe, 'low' costs the fewest tokens"
+    )
+    IMAGE_TO_IMAGE_PIXELS: int = Field(1024 * 1024, help="Maximum pixels of the images uploaded for image generation")
+    UPLOAD_CACHE_BYTES: int = Field(32 * 1024 * 1024, help="Memory budget of the images prepared for uploading")
+    DESCRIPTION_CACHE_BYTES: int = Field(64 * 1024 * 1024, help="Disk budget of the cached image descriptions")
+    DESCRIPTION_CACHE_ITEMS: int = Field(1024, help="Number of image descriptions also cached in memory")
+    MERGE_CACHE_BYTES: int = Field(16 * 1024 * 1024, help="Disk budget of the cached merged image prompts")
+    MERGE_CACHE_ITEMS: int = Field(1024, help="Number of merged image prompts also cached in memory")
+    JOB_WORKERS: int = Field(4, help="Number of image generations run at the same time")
+    JOB_QUEUE_SIZE: int = Field(32, help="Number of image generations that can wait before new ones are refused")
+    JOB_RETRY_AFTER: int = Field(10, help="Seconds clients are told to wait when the generation queue is full")
+    OPENAI_CONCURRENCY: int = Field(4, help="Maximum number of concurrent calls to OpenAI")
+    STABILITY_CONCURRENCY: int = Field(2, help="Maximum number of concurrent calls to Stability AI")
+    GENERATION_VARIANTS: int = Field(
+        1, help="Number of images generated in parallel for each step of a generation, the first to succeed is used"
+    )
+    GENERATION_STRENGTHS: List[float] = Field([0.6], help="Strengths of the parallel generations, in turn, as JSON")
+    GENERATION_KEEP_VARIANTS: bool = Field(
+        False, help="Wait for all the parallel generations, and keep the unused ones in the variants directory"
+    )
+    PROVIDER_RATE_LIMITS: Dict[str, float] = Field(
+        {"openai:gpt-4o-mini": 500, "stability": 900},
+        help="Requests per minute allowed by each provider, or 'provider:model', as JSON. Others are not limited"
+    )
+    PROVIDER_MAX_RETRIES: int = Field(4, help="Number of times a rate limited or temporarily failed call is retried")
+    PROVIDER_BACKOFF_BASE: float = Field(1.0, help="Seconds of the first retry delay, doubled on every retry")
+    PROVIDER_BACKOFF_MAX: float = Field(30.0, help="Maximum seconds to wait before retrying a provider call")
 
     # to read API keys etc. from environment variables model_config should be defined in here
     OPENAI_API_KEY:str = ""
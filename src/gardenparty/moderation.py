@@ -0,0 +1,166 @@
+"""
+Moderation status of the generated images.
+
+Every image starts as pending, until a moderator accepts or rejects it. Decisions are appended to `accepted.csv`
+(`filename,status` rows, later rows overriding earlier ones), and kept in memory so that checking the status of an
+image, or finding the next pending one, doesn't read the file. Rows appended by other worker processes are picked up
+by reading the file from where the previous read stopped.
+"""
+import csv
+import io
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Literal, Set
+
+from .catalog import Snapshot
+
+logger = logging.getLogger(__name__)
+
+Status = Literal['pending', 'accepted', 'rejected']
+
+STATUSES = ('pending', 'accepted', 'rejected')
+
+HEADER = "filename,status\n"
+
+
+class ModerationQueue:
+    """
+    Moderation statuses persisted in the append-only CSV file at `path`.
+
+    With `required`, only accepted images are visible. Otherwise all images except the rejected ones are.
+    """
+
+    def __init__(self, path: Path, required: bool = False, poll_interval: float = 1.0):
+        self.path = Path(path)
+        self.required = required
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._status: Dict[str, Status] = {}
+        # Pending images of the catalog, in the order they appeared
+        self._pending: "OrderedDict[str, None]" = OrderedDict()
+        self._images: Set[str] = set()
+        self._offset = 0
+        self._last_poll = 0.0
+        self._changed: Set[str] = set()
+
+    def open(self) -> None:
+        """Create the moderation file if needed, and load the statuses saved so far."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', newline='') as file:
+            if file.tell() == 0:
+                file.write(HEADER)
+        self.refresh(force=True)
+
+    def status(self, name: str) -> Status:
+        return self._status.get(name, 'pending')
+
+    def is_visible(self, name: str) -> bool:
+        """Return whether image `name` can be shown on the voting and display pages."""
+        status = self._status.get(name, 'pending')
+        return status == 'accepted' or (not self.required and status != 'rejected')
+
+    def counts(self) -> Dict[str, int]:
+        """Return the number of catalog images in each status."""
+        counts = dict.fromkeys(STATUSES, 0)
+        with self._lock:
+            for name in self._images:
+                counts[self.status(name)] += 1
+        return counts
+
+    def next_pending(self, limit: int = 1) -> List[str]:
+        """Return at most `limit` images waiting for moderation, oldest first."""
+        with self._lock:
+            pending = []
+            for name in self._pending:
+                if len(pending) >= limit:
+                    break
+                pending.append(name)
+            return pending
+
+    def set_statuses(self, statuses: Dict[str, Status]) -> Set[str]:
+        """
+        Save the moderation decisions in `statuses`, a mapping from image names to statuses.
+
+        Returns the names of the images whose status changed.
+        """
+        for name, status in statuses.items():
+            if status not in STATUSES:
+                raise ValueError(f"Unknown moderation status {status!r}")
+            if not name or name != Path(name).name:
+                raise ValueError(f"Invalid image name {name!r}")
+
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator='\n').writerows(statuses.items())
+        # A single write to a file opened for appending, so rows of concurrent writers never interleave
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, buffer.getvalue().encode())
+        finally:
+            os.close(fd)
+        return self.refresh(force=True)
+
+    def refresh(self, force: bool = False) -> Set[str]:
+        """
+        Read the rows appended to the moderation file since the previous refresh.
+
+        Returns the names of the images whose status changed since the previous call, including the changes made
+        through `set_statuses()`. Unless `force` is given, the file is checked at most every `poll_interval` seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if force or now - self._last_poll >= self.poll_interval:
+                self._last_poll = now
+                self._read()
+            changed, self._changed = self._changed, set()
+        return changed
+
+    def _read(self) -> None:
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(self._offset)
+                data = file.read()
+        except FileNotFoundError:
+            return
+
+        # Leave a partially written last row for the next read
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return
+        self._offset += end
+
+        for row in csv.reader(io.StringIO(data[:end].decode())):
+            if len(row) != 2 or row == ['filename', 'status']:
+                continue
+            name, status = row
+            if status not in STATUSES:
+                logger.warning("Unknown moderation status %r of %s in %s", status, name, self.path)
+                continue
+            if self._status.get(name, 'pending') == status:
+                continue
+            self._status[name] = status
+            self._changed.add(name)
+            if status == 'pending' and name in self._images:
+                self._pending[name] = None
+            else:
+                self._pending.pop(name, None)
+
+    def update_images(self, snapshot: Snapshot, changed: Set[str]) -> None:
+        """Catalog listener that keeps the queue of pending images up to date."""
+        with self._lock:
+            added = []
+            for name in changed:
+                image = snapshot.by_name.get(name)
+                if image is None:
+                    self._images.discard(name)
+                    self._pending.pop(name, None)
+                elif name not in self._images:
+                    self._images.add(name)
+                    added.append(image)
+            for image in sorted(added, key=lambda i: (i.ctime, i.name)):
+                if self._status.get(image.name, 'pending') == 'pending':
+                    self._pending[image.name] = None
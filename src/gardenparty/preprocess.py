@@ -18,8 +18,11 @@ import numpy as np
 
 from typing import Tuple
 
+from .metrics import PREPROCESS_SECONDS
+
 logger = logging.getLogger(__name__)
 
+@PREPROCESS_SECONDS.time(stage='load')
 def preprocess_image(image_path) -> Tuple[np.ndarray, np.ndarray]:
     # Load the image
     image = cv2.imread(image_path)
@@ -38,6 +41,7 @@ def preprocess_image(image_path) -> Tuple[np.ndarray, np.ndarray]:
 #     cv2.imwrite('edged.jpg', dilated)
 #     return dilated
 
+@PREPROCESS_SECONDS.time(stage='find_contours')
 def find_document_contours(blurred):
     """
     Try to detect edges using Canny. If that fails, use binary thresholding.
@@ -77,6 +81,7 @@ def _find_document_contours(edged) -> np.ndarray:
     raise ValueError("No suitable contour found with 4 or more points.")
 
 
+@PREPROCESS_SECONDS.time(stage='perspective')
 def get_document_perspective(image, contour) -> np.ndarray:
     # Get the points from the contour
     points = np.array([point[0] for point in contour], dtype='float32')
@@ -115,6 +120,7 @@ def get_document_perspective(image, contour) -> np.ndarray:
     return warped
 
 
+@PREPROCESS_SECONDS.time(stage='trim_whitespace')
 def trim_whitespace(image) -> np.ndarray:
     # Convert to grayscale
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -141,6 +147,7 @@ def trim_whitespace(image) -> np.ndarray:
         return cropped_img
     return image
 
+@PREPROCESS_SECONDS.time(stage='enhance_contrast')
 def enhance_contrast(image) -> np.ndarray:
     # Improve contrast using CLAHE (adaptive histogram equalization)
     lab = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
@@ -157,6 +164,7 @@ def enhance_contrast(image) -> np.ndarray:
     return enhanced_image
 
 
+@PREPROCESS_SECONDS.time(stage='scale_and_crop')
 def scale_and_crop(image, max_size=1024, aspect_ratio_max=2.5):
     # Get the current dimensions of the image
     height, width = image.shape[:2]
@@ -183,6 +191,7 @@ def scale_and_crop(image, max_size=1024, aspect_ratio_max=2.5):
     return scaled_image
 
 
+@PREPROCESS_SECONDS.time(stage='white_balance')
 def white_balance(img):
     result = cv2.cvtColor(img, cv2.COLOR_BGR2LAB)
     avg_a = np.average(result[:, :, 1])
@@ -237,7 +246,7 @@ def autocrop_and_straighten(image_path, output_path) -> None:
 def save_image_as(source: str, target: str) -> None:
     image = cv2.imread(source)
     cv2.imwrite(target, image)
-    print(f"Image saved as {target}")
+    logger.info(f"Image saved as {target}")
 
 
 if __name__ == "__main__":
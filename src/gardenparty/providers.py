@@ -0,0 +1,199 @@
+"""
+HTTP clients of the AI service providers.
+
+A generation makes several calls to OpenAI and Stability AI. Making a new connection for each call costs a TCP and TLS
+handshake every time, so the clients are created once per process and keep their connections alive between calls.
+HTTP/2 is used when the optional `h2` package is installed (`pip install httpx[http2]`).
+
+Calls are made with `call()`, which keeps them within the rate limits of the providers, retries the ones that failed
+temporarily, and raises a `ProviderError` subclass for the ones that failed for good.
+"""
+import importlib.util
+import logging
+import threading
+import time
+from typing import Any, Callable, Optional
+
+import httpx
+import openai
+from openai import OpenAI
+
+from .app import settings
+from .metrics import PROVIDER_RETRIES
+from .ratelimit import RateLimiter, backoff_delay, retry_after
+
+logger = logging.getLogger(__name__)
+
+OPENAI_CHAT_URL = settings.OPENAI_BASE_URL.rstrip("/") + "/chat/completions"
+STABILITY_SD3_URL = settings.STABILITY_BASE_URL.rstrip("/") + "/v2beta/stable-image/generate/sd3"
+
+_lock = threading.Lock()
+_http_client: Optional[httpx.Client] = None
+_openai_client: Optional[OpenAI] = None
+
+rate_limiter = RateLimiter(settings.PROVIDER_RATE_LIMITS)
+
+
+class ProviderError(Exception):
+    """
+    A call to an AI service provider failed.
+    """
+
+    def __init__(self, provider: str, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+
+class RateLimited(ProviderError):
+    """The provider refused the call because of its rate limits."""
+
+
+class ProviderUnavailable(ProviderError):
+    """The provider failed temporarily: a server error, a timeout or a connection failure."""
+
+
+class ContentRejected(ProviderError):
+    """The provider refused the content of the call, such as by its content moderation."""
+
+
+class InvalidResponse(ProviderError):
+    """The provider responded with something other than the call expected."""
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def _new_http_client() -> httpx.Client:
+    return httpx.Client(
+        timeout=httpx.Timeout(settings.PROVIDER_TIMEOUT, connect=settings.PROVIDER_CONNECT_TIMEOUT),
+        limits=httpx.Limits(
+            max_connections=settings.PROVIDER_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.PROVIDER_MAX_CONNECTIONS,
+            keepalive_expiry=settings.PROVIDER_KEEPALIVE,
+        ),
+        http2=http2_available(),
+    )
+
+
+def get_http_client() -> httpx.Client:
+    """Return the connection-pooling HTTP client shared by the calls of this process."""
+    global _http_client
+
+    if _http_client is None:
+        with _lock:
+            if _http_client is None:
+                _http_client = _new_http_client()
+                logger.debug("Created provider HTTP client, HTTP/2 %s", "on" if http2_available() else "off")
+    return _http_client
+
+
+def get_openai_client() -> OpenAI:
+    """Return the OpenAI client shared by the calls of this process."""
+    global _openai_client
+
+    if _openai_client is None:
+        with _lock:
+            if _openai_client is None:
+                _openai_client = OpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL,
+                    timeout=httpx.Timeout(settings.PROVIDER_TIMEOUT, connect=settings.PROVIDER_CONNECT_TIMEOUT),
+                    http_client=_new_http_client(),
+                    # Retried by call(), within the rate limits
+                    max_retries=0,
+                )
+    return _openai_client
+
+
+def close() -> None:
+    """Close the clients and their connections. They are created again on the next call."""
+    global _http_client, _openai_client
+
+    with _lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+        if _openai_client is not None:
+            _openai_client.close()
+            _openai_client = None
+
+
+def _error_details(response: httpx.Response) -> dict:
+    # OpenAI nests the details in "error", Stability AI gives them at the top level
+    try:
+        body = response.json()
+    except ValueError:
+        return {'message': response.text[:500]}
+    if not isinstance(body, dict):
+        return {'message': str(body)[:500]}
+    error = body.get('error')
+    return error if isinstance(error, dict) else body
+
+
+def check_response(provider: str, response: httpx.Response) -> httpx.Response:
+    """Return `response` if the call succeeded, or raise the `ProviderError` matching its status."""
+    status = response.status_code
+    if status < 400:
+        return response
+
+    # A streamed response has not been read yet
+    response.read()
+    details = _error_details(response)
+    code = details.get('code') or details.get('name')
+    message = f"HTTP {status}{f' {code}' if code else ''}: {details.get('message') or details.get('errors') or ''}"
+
+    # Running out of quota also responds with 429, but waiting does not help with it
+    if status == 429 and code != 'insufficient_quota':
+        raise RateLimited(provider, message, status, retry_after(response))
+    if status in (408, 409) or status >= 500:
+        raise ProviderUnavailable(provider, message, status, retry_after(response))
+    if code in ('content_moderation', 'content_policy_violation', 'content_filter'):
+        raise ContentRejected(provider, message, status)
+    raise ProviderError(provider, message, status)
+
+
+def _send(provider: str, send: Callable[[], Any]) -> Any:
+    try:
+        result = send()
+    except openai.APIStatusError as e:
+        check_response(provider, e.response)
+        raise ProviderError(provider, str(e), e.status_code) from e
+    except (openai.APIConnectionError, httpx.TransportError) as e:
+        raise ProviderUnavailable(provider, str(e) or type(e).__name__) from e
+    if isinstance(result, httpx.Response):
+        check_response(provider, result)
+    return result
+
+
+def call(provider: str, send: Callable[[], Any], model: Optional[str] = None) -> Any:
+    """
+    Return the result of `send()`, a call to `model` of `provider`, made within their rate limits.
+
+    `send` returns an `httpx.Response`, or the result of an OpenAI client call. Calls that were rate limited or failed
+    temporarily are retried up to `PROVIDER_MAX_RETRIES` times, after the delay asked by the provider or else an
+    exponential backoff with jitter.
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire(provider, model)
+        try:
+            return _send(provider, send)
+        except (RateLimited, ProviderUnavailable) as e:
+            if attempt >= settings.PROVIDER_MAX_RETRIES:
+                raise
+            delay = e.retry_after
+            if delay is None:
+                delay = backoff_delay(attempt, settings.PROVIDER_BACKOFF_BASE, settings.PROVIDER_BACKOFF_MAX)
+            elif delay > settings.PROVIDER_BACKOFF_MAX:
+                # Rather fail now than keep the user waiting
+                raise
+            elif isinstance(e, RateLimited):
+                # The other calls to the provider would be refused too
+                rate_limiter.pause(provider, delay, model)
+            attempt += 1
+            PROVIDER_RETRIES.inc(provider=provider, error=type(e).__name__)
+            logger.warning("Retrying call to %s in %.1f seconds, attempt %d: %s", provider, delay, attempt, e)
+            time.sleep(delay)
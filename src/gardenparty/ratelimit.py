@@ -0,0 +1,118 @@
+"""
+Rate limiting and retrying of the calls to the AI service providers.
+
+Every provider, and every model of a provider, allows a number of requests per minute. A `RateLimiter` keeps a token
+bucket for each, so calls are spread out to stay under the limits instead of bursting into 429 responses. When a
+provider still asks to slow down, or fails temporarily, the call is retried after an exponentially growing, jittered
+delay, or after the time the provider asked for in its `Retry-After` header.
+"""
+import email.utils
+import random
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average, and bursts of up to `capacity` calls.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        # Take a token, possibly going into debt, and return the seconds until the debt is paid
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            return max(wait, self._paused_until - now)
+
+    def acquire(self) -> float:
+        """Wait until a call is allowed, and return the seconds waited."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def try_acquire(self) -> bool:
+        """Take a call if one is allowed now, without waiting. Returns False if none is."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1 or now < self._paused_until:
+                return False
+            self._tokens -= 1
+            return True
+
+    def pause(self, seconds: float) -> None:
+        """Allow no calls for `seconds`, such as when the provider responded with `Retry-After`."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """
+    Token buckets of the providers and their models.
+
+    `limits` gives the requests per minute allowed for a provider, such as "openai", or for a model of a provider, such
+    as "openai:gpt-4o-mini". Calls to providers and models without a limit are not limited.
+    """
+
+    def __init__(self, limits: Dict[str, float], burst: float = 1 / 6):
+        # A burst of a sixth of the per-minute limit, the allowance of ten seconds
+        self._buckets = {
+            name: TokenBucket(per_minute / 60, max(1.0, per_minute * burst))
+            for name, per_minute in limits.items() if per_minute > 0
+        }
+
+    def _buckets_of(self, provider: str, model: Optional[str]) -> Tuple[TokenBucket, ...]:
+        names = (provider, f"{provider}:{model}") if model else (provider,)
+        return tuple(self._buckets[name] for name in names if name in self._buckets)
+
+    def acquire(self, provider: str, model: Optional[str] = None) -> float:
+        """Wait until a call to `model` of `provider` is allowed, and return the seconds waited."""
+        return sum(bucket.acquire() for bucket in self._buckets_of(provider, model))
+
+    def pause(self, provider: str, seconds: float, model: Optional[str] = None) -> None:
+        for bucket in self._buckets_of(provider, model):
+            bucket.pause(seconds)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Return the delay before retry number `attempt` (from 0): random up to `base * 2**attempt`, at most `cap`."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(response: httpx.Response) -> Optional[float]:
+    """Return the seconds the provider asked to wait before retrying, or None if it did not say."""
+    # OpenAI also gives milliseconds, which is more precise for short waits
+    value = response.headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,159 @@
+"""
+Elo ratings of the generated images.
+
+Ratings, and the ranking of the images by them, are updated incrementally on every vote, and rebuilt at startup from
+the whole vote log by fitting a Bradley-Terry model, which uses the same scale as Elo: image A beats image B with
+probability `1 / (1 + 10 ** ((rating_b - rating_a) / 400))`.
+"""
+import bisect
+import logging
+import threading
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INITIAL_RATING = 1500.0
+
+# Number of minorization-maximization iterations when fitting the Bradley-Terry model
+FIT_ITERATIONS = 100
+
+
+class Rating(NamedTuple):
+    image: str
+    rating: float
+    wins: int
+    displays: int
+
+
+class Ratings:
+    """
+    Per-image Elo ratings, win and display counts.
+    """
+
+    def __init__(self, k_factor: float = 24.0):
+        self.k_factor = k_factor
+        self._lock = threading.Lock()
+        # (-rating, image id) of every image, sorted, so the highest rated come first and ties keep the id order
+        self._ranked: List[Tuple[float, int]] = []
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.ratings = np.zeros(0, dtype=np.float64)
+        self.wins = np.zeros(0, dtype=np.int64)
+        self.displays = np.zeros(0, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _intern(self, name: str) -> int:
+        image_id = self.ids.get(name)
+        if image_id is None:
+            image_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = image_id
+            if image_id == len(self.ratings):
+                size = max(64, 2 * len(self.ratings))
+                self.ratings = np.resize(self.ratings, size)
+                self.wins = np.resize(self.wins, size)
+                self.displays = np.resize(self.displays, size)
+            self.ratings[image_id] = INITIAL_RATING
+            self.wins[image_id] = 0
+            self.displays[image_id] = 0
+            bisect.insort(self._ranked, (-INITIAL_RATING, image_id))
+        return image_id
+
+    def _set_rating(self, image_id: int, rating: float) -> None:
+        # Move the image in the ranking: a binary search and a shift of the list instead of sorting it again
+        del self._ranked[bisect.bisect_left(self._ranked, (-float(self.ratings[image_id]), image_id))]
+        self.ratings[image_id] = rating
+        bisect.insort(self._ranked, (-float(rating), image_id))
+
+    def _rank_all(self) -> None:
+        n = len(self.names)
+        self._ranked = sorted(zip((-self.ratings[:n]).tolist(), range(n)))
+
+    def update(self, winner: str, loser: str) -> None:
+        """Apply a single Elo update for a vote where `winner` was preferred over `loser`."""
+        with self._lock:
+            winner_id = self._intern(winner)
+            loser_id = self._intern(loser)
+            expected = 1 / (1 + 10 ** ((self.ratings[loser_id] - self.ratings[winner_id]) / 400))
+            delta = self.k_factor * (1 - expected)
+            self._set_rating(winner_id, self.ratings[winner_id] + delta)
+            self._set_rating(loser_id, self.ratings[loser_id] - delta)
+            self.wins[winner_id] += 1
+            self.displays[winner_id] += 1
+            self.displays[loser_id] += 1
+
+    def rebuild(self, winners: Sequence[str], losers: Sequence[str]) -> None:
+        """
+        Replace all ratings with a Bradley-Terry fit of the given votes.
+
+        Every image also gets one virtual win and one virtual loss against an image rated `INITIAL_RATING`, which keeps
+        the fit finite for images that have never won or never lost.
+        """
+        names, inverse = np.unique(np.concatenate([np.asarray(winners, dtype=str), np.asarray(losers, dtype=str)]),
+                                   return_inverse=True)
+        winner_ids, loser_ids = np.split(inverse, 2)
+        n = len(names)
+
+        wins = np.bincount(winner_ids, minlength=n)
+        displays = wins + np.bincount(loser_ids, minlength=n)
+
+        # Minorization-maximization updates of the Bradley-Terry strengths
+        strengths = np.ones(n)
+        for _ in range(FIT_ITERATIONS):
+            inverse_sums = 1 / (strengths[winner_ids] + strengths[loser_ids])
+            denominator = (np.bincount(winner_ids, inverse_sums, n) + np.bincount(loser_ids, inverse_sums, n)
+                           + 2 / (strengths + 1))
+            strengths = (wins + 1) / denominator
+
+        with self._lock:
+            self.names = []
+            self.ids = {}
+            self.ratings = np.zeros(0, dtype=np.float64)
+            self.wins = np.zeros(0, dtype=np.int64)
+            self.displays = np.zeros(0, dtype=np.int64)
+            self._ranked = []
+            for name in names.tolist():
+                self._intern(name)
+            self.ratings[:n] = INITIAL_RATING + 400 * np.log10(strengths)
+            self.wins[:n] = wins
+            self.displays[:n] = displays
+            self._rank_all()
+        logger.info("Rebuilt ratings of %d images from %d votes", n, len(winner_ids))
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Return copies of the rating arrays, for saving in a snapshot."""
+        with self._lock:
+            n = len(self.names)
+            return {
+                'names': np.array(self.names, dtype=str),
+                'ratings': self.ratings[:n].copy(),
+                'wins': self.wins[:n].copy(),
+                'displays': self.displays[:n].copy(),
+            }
+
+    def restore(self, names: np.ndarray, ratings: np.ndarray, wins: np.ndarray, displays: np.ndarray) -> None:
+        """Replace all ratings with a `state()` saved earlier."""
+        with self._lock:
+            self.names = names.tolist()
+            self.ids = {name: image_id for image_id, name in enumerate(self.names)}
+            self.ratings = ratings.astype(np.float64)
+            self.wins = wins.astype(np.int64)
+            self.displays = displays.astype(np.int64)
+            self._rank_all()
+
+    def ranking(self) -> List[int]:
+        """Return the image ids ordered from the highest rating to the lowest."""
+        with self._lock:
+            return [image_id for _, image_id in self._ranked]
+
+    def get(self, image_id: int) -> Rating:
+        return Rating(
+            image=self.names[image_id],
+            rating=float(self.ratings[image_id]),
+            wins=int(self.wins[image_id]),
+            displays=int(self.displays[image_id]),
+        )
@@ -0,0 +1,87 @@
+"""
+Resized and re-encoded renditions of the images.
+
+The pages show the images as tiles much smaller than the originals. Renditions are made on first request (or when a new
+image appears), stored on disk keyed by the content hash of the source image, the size and the format, and evicted
+least recently used first when the cache grows over its disk budget.
+"""
+import logging
+from pathlib import Path
+from typing import Tuple
+
+import cv2
+
+from .cache import DiskLRU, file_digest, forget_digest
+
+logger = logging.getLogger(__name__)
+
+# Allowed sizes of the longest side, in pixels
+SIZES = (256, 512, 1024)
+
+# Format name -> (file suffix, content type, OpenCV encoding parameters)
+FORMATS = {
+    'webp': ('.webp', 'image/webp', [cv2.IMWRITE_WEBP_QUALITY, 80]),
+    'jpeg': ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 82, cv2.IMWRITE_JPEG_PROGRESSIVE, 1]),
+}
+
+
+class RenditionStore:
+    """
+    Disk cache of image renditions under `cache_dir`, limited to `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.files = DiskLRU(cache_dir, max_bytes)
+
+    def content_hash(self, source: Path) -> str:
+        """Return the SHA-256 of `source`, cached until the file changes."""
+        return file_digest(source)
+
+    def name(self, digest: str, size: int, fmt: str) -> str:
+        return f"{digest}_{size}{FORMATS[fmt][0]}"
+
+    def path(self, digest: str, size: int, fmt: str) -> Path:
+        return self.files.path(self.name(digest, size, fmt))
+
+    def get(self, source: Path, size: int, fmt: str) -> Tuple[Path, str]:
+        """
+        Return the path and content hash of the `size` px `fmt` rendition of `source`, making it if needed.
+        """
+        if size not in SIZES:
+            raise ValueError(f"Unsupported rendition size {size}")
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported rendition format {fmt!r}")
+
+        digest = self.content_hash(source)
+        name = self.name(digest, size, fmt)
+        if self.files.touch(name):
+            return self.files.path(name), digest
+        try:
+            data = self._render(source, size, fmt)
+        except ValueError:
+            # The source may still be being written, so it is hashed again on the next request
+            forget_digest(source)
+            raise
+        return self.files.write(name, data), digest
+
+    def _render(self, source: Path, size: int, fmt: str) -> bytes:
+        image = cv2.imread(str(source))
+        if image is None:
+            raise ValueError(f"Failed to read image {source}")
+
+        # Shrink the longest side to `size`, never enlarge
+        height, width = image.shape[:2]
+        scale = size / max(width, height)
+        if scale < 1:
+            image = cv2.resize(image, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+
+        suffix, _content_type, params = FORMATS[fmt]
+        ok, data = cv2.imencode(suffix, image, params)
+        if not ok:
+            raise ValueError(f"Failed to encode {source} as {fmt}")
+        return data.tobytes()
+
+    def evict(self) -> None:
+        """Remove the least recently used renditions until the cache is 10% under its budget."""
+        self.files.evict()
@@ -0,0 +1,175 @@
+"""
+Weighted random sampling with incremental updates.
+
+The weights are kept in a Fenwick (binary indexed) tree, so changing one weight and drawing an item both take
+O(log n), instead of rebuilding and normalizing a weight array for every draw.
+"""
+import math
+import random
+import time
+from typing import Callable, Dict, Generic, Hashable, List, Optional, Sequence, TypeVar
+
+K = TypeVar('K', bound=Hashable)
+
+
+class WeightedSampler:
+    """
+    Draws indexes 0..n-1 with probability proportional to their weights.
+    """
+
+    def __init__(self, weights: Sequence[float] = (), random: Callable[[], float] = random.random):
+        self.random = random
+        self.rebuild(weights)
+
+    def __len__(self) -> int:
+        return len(self._weights)
+
+    @property
+    def total(self) -> float:
+        return self._total
+
+    def rebuild(self, weights: Sequence[float]) -> None:
+        """Replace all weights, in O(n)."""
+        self._weights: List[float] = [float(w) for w in weights]
+        self._grow(len(self._weights))
+
+    def _grow(self, size: int) -> None:
+        capacity = 1
+        while capacity < size:
+            capacity *= 2
+        self._weights.extend([0.0] * (size - len(self._weights)))
+
+        tree = [0.0] * (capacity + 1)
+        for i in range(1, capacity + 1):
+            if i <= size:
+                tree[i] += self._weights[i - 1]
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self._tree = tree
+        self._total = math.fsum(self._weights)
+
+    def get(self, index: int) -> float:
+        return self._weights[index]
+
+    def set(self, index: int, weight: float) -> None:
+        """Set the weight of `index`, growing the sampler if needed."""
+        if weight < 0:
+            raise ValueError("Weights must be non-negative")
+        if index >= len(self._weights):
+            if index >= len(self._tree) - 1:
+                self._grow(index + 1)
+            else:
+                self._weights.extend([0.0] * (index + 1 - len(self._weights)))
+
+        delta = weight - self._weights[index]
+        self._weights[index] = weight
+        self._total += delta
+        tree = self._tree
+        i = index + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def sample(self) -> int:
+        """Draw one index. Raises `ValueError` if all weights are zero."""
+        n = len(self._weights)
+        for _ in range(8):
+            if self._total <= 0:
+                break
+            remaining = self.random() * self._total
+            position = 0
+            step = (len(self._tree) - 1) or 1
+            tree = self._tree
+            while step:
+                following = position + step
+                if following < len(tree) and tree[following] <= remaining:
+                    position = following
+                    remaining -= tree[following]
+                step //= 2
+            # Rounding errors can push the draw past the last item, or onto an item with zero weight
+            if position < n and self._weights[position] > 0:
+                return position
+        if any(w > 0 for w in self._weights):
+            # Accumulated rounding errors, start from exact sums
+            self.rebuild(self._weights)
+            return self.sample()
+        raise ValueError("Cannot sample, all weights are zero")
+
+    def sample_distinct(self, k: int) -> List[int]:
+        """Draw `k` distinct indexes, each draw proportional to the weights of the items not drawn yet."""
+        drawn = []
+        try:
+            for _ in range(k):
+                index = self.sample()
+                drawn.append((index, self._weights[index]))
+                self.set(index, 0.0)
+        finally:
+            for index, weight in reversed(drawn):
+                self.set(index, weight)
+        return [index for index, _weight in drawn]
+
+
+class KeyedSampler(Generic[K]):
+    """
+    Weighted sampler of arbitrary keys, reusing the slots of removed keys.
+    """
+
+    def __init__(self, random: Callable[[], float] = random.random):
+        self._sampler = WeightedSampler(random=random)
+        self._slots: Dict[K, int] = {}
+        self._keys: List[Optional[K]] = []
+        self._free: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._slots
+
+    def set(self, key: K, weight: float) -> None:
+        slot = self._slots.get(key)
+        if slot is None:
+            if self._free:
+                slot = self._free.pop()
+                self._keys[slot] = key
+            else:
+                slot = len(self._keys)
+                self._keys.append(key)
+            self._slots[key] = slot
+        self._sampler.set(slot, weight)
+
+    def remove(self, key: K) -> None:
+        slot = self._slots.pop(key, None)
+        if slot is not None:
+            self._sampler.set(slot, 0.0)
+            self._keys[slot] = None
+            self._free.append(slot)
+
+    def sample_distinct(self, k: int) -> List[K]:
+        """Draw `k` distinct keys. Raises `ValueError` if there are not enough keys with a positive weight."""
+        if len(self._slots) < k:
+            raise ValueError(f"Cannot sample {k} of {len(self._slots)} items")
+        return [self._keys[slot] for slot in self._sampler.sample_distinct(k)]
+
+
+class RecencyWeight:
+    """
+    Weight that halves for every `half_life` seconds of age, or is constant if `half_life` is 0.
+
+    Weights are relative to a fixed reference time, so they don't need to be recomputed as time passes: the ratio of
+    the weights of two images depends only on the difference of their timestamps.
+    """
+
+    # Largest exponent used, to keep the weights finite far from the reference time
+    MAX_EXPONENT = 1000
+
+    def __init__(self, half_life: float, reference: Optional[float] = None):
+        self.half_life = half_life
+        self.reference = time.time() if reference is None else reference
+
+    def __call__(self, timestamp: float) -> float:
+        if not self.half_life:
+            return 1.0
+        exponent = (timestamp - self.reference) / self.half_life
+        return 2.0 ** max(-self.MAX_EXPONENT, min(exponent, self.MAX_EXPONENT))
@@ -0,0 +1,108 @@
+"""
+Coalescing of identical calls in flight.
+
+Users double-click, reload the page and upload the same drawing again, so the same slow call to an AI service is often
+made while an identical one is still running. A `SingleFlight` lets the first call run and makes the others with the
+same key wait for it and share its result, or its error, instead of paying for the call again.
+"""
+import asyncio
+import inspect
+import logging
+import threading
+from concurrent.futures import Executor, Future
+from typing import Any, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from .metrics import COALESCED_CALLS
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time, the concurrent calls with the same key get the result of the running one.
+
+    `name` labels the coalesced calls in the metrics.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, Future] = {}
+        # Running coroutines, referenced until they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        # Return the future of the call in flight, and whether this caller has to make the call
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                COALESCED_CALLS.inc(call=self.name)
+                logger.debug("Waiting for the %s call in flight for %s", self.name, key)
+                return future, False
+            future = self._calls[key] = Future()
+            # A running future can not be cancelled by one of the callers
+            future.set_running_or_notify_cancel()
+            return future, True
+
+    def _finish(self, key: Hashable, future: Future, result: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _call(self, key: Hashable, future: Future, func: Callable[..., Any], args: tuple, kwargs: dict) -> None:
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+        else:
+            self._finish(key, future, result)
+
+    async def _call_async(self, key: Hashable, future: Future, func: Callable[..., Any], args: tuple, kwargs: dict):
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+        else:
+            self._finish(key, future, result)
+
+    def do(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """Return `func(*args, **kwargs)`, or the result of the call with `key` already in flight."""
+        future, leader = self._join(key)
+        if leader:
+            self._call(key, future, func, args, kwargs)
+        return future.result()
+
+    def start(
+        self, key: Hashable, executor: Executor, func: Callable[..., Any], *args, **kwargs
+    ) -> Tuple[Future, bool]:
+        """
+        Like `do()`, without waiting: return the future of the call with `key` in flight, or of `func(*args, **kwargs)`
+        started in `executor`, and whether this call started it.
+        """
+        future, leader = self._join(key)
+        if leader:
+            try:
+                executor.submit(self._call, key, future, func, args, kwargs)
+            except RuntimeError as e:
+                # The executor is shut down
+                self._finish(key, future, error=e)
+        return future, leader
+
+    async def do_async(self, key: Hashable, func: Callable[..., Any], *args, **kwargs) -> Any:
+        """
+        Like `do()`, without blocking the event loop. `func` is a coroutine function, or a blocking function that is
+        run in the default executor. Calls are coalesced with the ones made with `do()` too.
+        """
+        future, leader = self._join(key)
+        if leader:
+            if inspect.iscoroutinefunction(func):
+                task = asyncio.ensure_future(self._call_async(key, future, func, args, kwargs))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            else:
+                asyncio.get_running_loop().run_in_executor(None, self._call, key, future, func, args, kwargs)
+        # Shielded, so that a caller going away leaves the call running for the others
+        return await asyncio.shield(asyncio.wrap_future(future))
@@ -0,0 +1,98 @@
+"""
+Snapshots of the in-memory vote state.
+
+Rebuilding the vote index and the ratings means replaying the whole vote log, which gets slow as the votes pile up. A
+snapshot stores the aggregated pair counts, ratings and win/display counts as NumPy arrays, together with the id of the
+last vote they include. At startup the snapshot is loaded and only the votes logged after it are replayed.
+"""
+import fcntl
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Dict, NamedTuple, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the arrays stored in a snapshot change, older snapshots are then ignored
+SNAPSHOT_VERSION = 1
+
+
+class VoteSnapshot(NamedTuple):
+    # Id of the last logged vote included in the snapshot
+    last_vote_id: int
+    # `VoteIndex.state()`
+    index: Dict[str, np.ndarray]
+    # `Ratings.state()`
+    ratings: Dict[str, np.ndarray]
+
+
+def save_snapshot(path: Path, snapshot: VoteSnapshot) -> bool:
+    """
+    Write `snapshot` to `path`, atomically replacing the previous snapshot unless that one already includes the same or
+    later votes. Returns whether the snapshot was written.
+    """
+    path = Path(path)
+    arrays = {
+        'version': np.array(SNAPSHOT_VERSION),
+        'last_vote_id': np.array(snapshot.last_vote_id),
+        **{f'index_{key}': value for key, value in snapshot.index.items()},
+        **{f'ratings_{key}': value for key, value in snapshot.ratings.items()},
+    }
+
+    # Several worker processes may write a snapshot at the same time, each through a file of its own
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    try:
+        with open(tmp, 'wb') as file:
+            np.savez(file, **arrays)
+        # The check and the replace are serialized with the other workers, so a slower writer of an older snapshot
+        # can't replace a newer one
+        with open(path.with_name(f".{path.name}.lock"), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            saved_vote_id = saved_snapshot_vote_id(path)
+            if saved_vote_id is not None and saved_vote_id >= snapshot.last_vote_id:
+                logger.info("Vote snapshot %s is already up to vote %d, not saving the one up to vote %d",
+                            path, saved_vote_id, snapshot.last_vote_id)
+                return False
+            os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    logger.info("Saved vote snapshot up to vote %d to %s", snapshot.last_vote_id, path)
+    return True
+
+
+def saved_snapshot_vote_id(path: Path) -> Optional[int]:
+    """Return the id of the last vote in the snapshot at `path`, or None if there is no usable snapshot."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != SNAPSHOT_VERSION:
+                return None
+            return int(data['last_vote_id'])
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning("Failed to read the vote id of snapshot %s", path)
+        return None
+
+
+def load_snapshot(path: Path) -> Optional[VoteSnapshot]:
+    """Read the snapshot at `path`. Returns None if there is none, or if it can't be used."""
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            if int(data['version']) != SNAPSHOT_VERSION:
+                logger.info("Ignoring vote snapshot %s of an older version", path)
+                return None
+            arrays = {key: data[key] for key in data.files}
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception("Failed to read vote snapshot %s, replaying the whole vote log", path)
+        return None
+
+    return VoteSnapshot(
+        last_vote_id=int(arrays['last_vote_id']),
+        index={key[len('index_'):]: value for key, value in arrays.items() if key.startswith('index_')},
+        ratings={key[len('ratings_'):]: value for key, value in arrays.items() if key.startswith('ratings_')},
+    )
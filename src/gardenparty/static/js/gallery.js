@@ -1,29 +1,60 @@
 document.addEventListener('DOMContentLoaded', () => {
     const galleryContainer = document.getElementById('gallery');
+    const sentinel = document.getElementById('gallery-sentinel');
 
-    // Fetch image URLs from the server
-    fetch('/get_all_images')
-        .then(response => response.json())
-        .then(imageUrls => {
-            imageUrls.forEach(url => {
-                // Create an <a> element for each image
-                const link = document.createElement('a');
-                link.href = url; // Set the href to the image URL
-                link.target = '_blank'; // Open in a new tab
-                
-                // Create an <img> element
-                const img = document.createElement('img');
-                img.src = url;
-                img.alt = 'Gallery Image';
-                img.className = 'gallery-image'; // Apply CSS class for styling
-                
-                // Append the image to the link, and the link to the gallery
-                link.appendChild(img);
-                galleryContainer.appendChild(link);
+    // Images are fetched a page at a time, newest first
+    let nextCursor = null;
+    let loading = false;
+    let finished = false;
+
+    function addImage(url) {
+        // Create an <a> element for each image
+        const link = document.createElement('a');
+        link.href = url; // Set the href to the image URL
+        link.target = '_blank'; // Open in a new tab
+
+        // Create an <img> element
+        const img = document.createElement('img');
+        img.src = url.replace('/generated_images/', '/renditions/generated/512/'); // Resized thumbnail
+        img.alt = 'Gallery Image';
+        img.loading = 'lazy';
+        img.className = 'gallery-image'; // Apply CSS class for styling
+
+        // Append the image to the link, and the link to the gallery
+        link.appendChild(img);
+        galleryContainer.appendChild(link);
+    }
+
+    function loadPage() {
+        if (loading || finished) return;
+        loading = true;
+
+        // Fetch image URLs from the server
+        const url = nextCursor ? `/get_all_images?cursor=${encodeURIComponent(nextCursor)}` : '/get_all_images';
+        fetch(url)
+            .then(response => response.json())
+            .then(page => {
+                page.images.forEach(addImage);
+                nextCursor = page.next_cursor;
+                finished = !nextCursor;
+                loading = false;
+                if (finished) {
+                    observer.disconnect();
+                } else if (sentinel.getBoundingClientRect().top < window.innerHeight) {
+                    // Keep filling the screen until the sentinel is pushed out of view
+                    loadPage();
+                }
+            })
+            .catch(error => {
+                loading = false;
+                console.error('Error fetching images:', error);
+                alert('Failed to load images. Please try again later.');
             });
-        })
-        .catch(error => {
-            console.error('Error fetching images:', error);
-            alert('Failed to load images. Please try again later.');
-        });
+    }
+
+    // Load the next page when the end of the gallery scrolls into view
+    const observer = new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) loadPage();
+    }, { rootMargin: '600px' });
+    observer.observe(sentinel);
 });
@@ -0,0 +1,85 @@
+"""
+Registry of the prompt themes in the `prompt_templates` directory.
+
+Every theme is a text file, named after the theme. The files are read once, and read again only when their
+modification time or size changes, so looking up a theme is a dictionary access.
+"""
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class Theme(NamedTuple):
+    name: str
+    path: Path
+    text: str
+    mtime_ns: int
+    size: int
+
+
+class ThemeRegistry:
+    """
+    Themes of the files in `directory`, checked for changes at most every `check_interval` seconds.
+    """
+
+    def __init__(self, directory: Path, check_interval: float = 2.0):
+        self.directory = Path(directory)
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._themes: Dict[str, Theme] = {}
+        self._last_check = float('-inf')
+
+    def refresh(self, force: bool = False) -> None:
+        """Load the new and changed theme files, and forget the removed ones."""
+        now = time.monotonic()
+        if not force and now - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            # Another thread may have loaded the themes while this one waited for the lock
+            if not force and time.monotonic() - self._last_check < self.check_interval:
+                return
+            themes = {}
+            try:
+                entries = sorted(os.scandir(self.directory), key=lambda e: e.name)
+            except FileNotFoundError:
+                entries = []
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith('.'):
+                    continue
+                name = Path(entry.name).stem
+                stat = entry.stat()
+                theme = self._themes.get(name)
+                if theme is None or (theme.mtime_ns, theme.size) != (stat.st_mtime_ns, stat.st_size):
+                    try:
+                        text = Path(entry.path).read_text()
+                    except OSError as e:
+                        logger.warning("Failed to read theme %s: %s", entry.path, e)
+                        continue
+                    theme = Theme(name, Path(entry.path), text, stat.st_mtime_ns, stat.st_size)
+                    logger.debug("Loaded theme %s from %s", name, entry.path)
+                themes[name] = theme
+            self._themes = themes
+            # Only now, so that other threads wait for the first load instead of seeing no themes
+            self._last_check = now
+
+    def exists(self) -> bool:
+        return self.directory.is_dir()
+
+    def get(self, name: str) -> Theme:
+        """Return the theme `name`, given with or without the file extension. Raises `KeyError` if there is none."""
+        self.refresh()
+        return self._themes[Path(name).stem]
+
+    def names(self) -> List[str]:
+        """Return the names of the themes in alphabetical order."""
+        self.refresh()
+        return list(self._themes)
+
+    def paths(self) -> List[Path]:
+        self.refresh()
+        return [theme.path for theme in self._themes.values()]
@@ -0,0 +1,144 @@
+"""
+Stores for the one-time vote tokens.
+
+A token is issued with every voting page, and redeemed when the vote for that page arrives. Tokens expire after a
+while and the number of live tokens is capped, so pages that are never voted on don't leak memory.
+
+The in-memory store only works with a single worker process. The SQLite store is shared by all workers using the same
+instance directory, so a token issued by one worker can be redeemed by another.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Literal, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Pair = Tuple[str, str]
+
+TokenBackend = Literal['memory', 'sqlite']
+
+# How many tokens to issue between purges of the expired tokens from the SQLite store
+PURGE_INTERVAL = 256
+
+
+class TokenStore(ABC):
+    """
+    Base class for the vote token stores.
+    """
+
+    def __init__(self, ttl: float = 600, max_size: int = 100_000):
+        self.ttl = ttl
+        self.max_size = max_size
+
+    @abstractmethod
+    def issue(self, token: str, pair: Pair) -> None:
+        """Store `token` for voting on `pair`."""
+
+    @abstractmethod
+    def redeem(self, token: str) -> Optional[Pair]:
+        """Remove `token` and return its pair, or None if the token is unknown or has expired."""
+
+
+class MemoryTokenStore(TokenStore):
+    """
+    Token store in a dictionary of the current process, evicting the oldest tokens first.
+    """
+
+    def __init__(self, ttl: float = 600, max_size: int = 100_000):
+        super().__init__(ttl, max_size)
+        self._lock = threading.Lock()
+        self._tokens: "OrderedDict[str, Tuple[float, Pair]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def issue(self, token: str, pair: Pair) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._tokens[token] = (now + self.ttl, pair)
+
+            # Tokens are in expiry order, so expired ones are at the front
+            while self._tokens:
+                expires, _pair = next(iter(self._tokens.values()))
+                if expires > now and len(self._tokens) <= self.max_size:
+                    break
+                self._tokens.popitem(last=False)
+
+    def redeem(self, token: str) -> Optional[Pair]:
+        with self._lock:
+            expires, pair = self._tokens.pop(token, (0, None))
+        if expires <= time.monotonic():
+            return None
+        return pair
+
+
+class SqliteTokenStore(TokenStore):
+    """
+    Token store in an SQLite database shared by the worker processes.
+    """
+
+    def __init__(self, path: Path, ttl: float = 600, max_size: int = 100_000):
+        super().__init__(ttl, max_size)
+        self.path = Path(path)
+        self._local = threading.local()
+        self._issued = 0
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tokens (
+                    token TEXT PRIMARY KEY,
+                    img1 TEXT NOT NULL,
+                    img2 TEXT NOT NULL,
+                    expires REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS tokens_expires ON tokens (expires);
+            """)
+        return conn
+
+    def issue(self, token: str, pair: Pair) -> None:
+        now = time.time()
+        self._conn.execute("INSERT OR REPLACE INTO tokens (token, img1, img2, expires) VALUES (?, ?, ?, ?)",
+                           (token, pair[0], pair[1], now + self.ttl))
+
+        self._issued += 1
+        if self._issued % PURGE_INTERVAL == 0:
+            self.purge(now)
+
+    def purge(self, now: Optional[float] = None) -> None:
+        """Delete the expired tokens, and the oldest ones above the size limit."""
+        conn = self._conn
+        conn.execute("DELETE FROM tokens WHERE expires <= ?", (now or time.time(),))
+        conn.execute(
+            "DELETE FROM tokens WHERE token IN (SELECT token FROM tokens ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.max_size,)
+        )
+
+    def redeem(self, token: str) -> Optional[Pair]:
+        row = self._conn.execute(
+            "DELETE FROM tokens WHERE token = ? RETURNING img1, img2, expires", (token,)
+        ).fetchone()
+        if row is None or row[2] <= time.time():
+            return None
+        return row[0], row[1]
+
+
+def create_token_store(backend: TokenBackend, path: Path, ttl: float, max_size: int) -> TokenStore:
+    """Create a token store of the given `backend` type. `path` is only used by the SQLite store."""
+    if backend == 'memory':
+        return MemoryTokenStore(ttl=ttl, max_size=max_size)
+    if backend == 'sqlite':
+        return SqliteTokenStore(path, ttl=ttl, max_size=max_size)
+    raise ValueError(f"Unknown vote token backend {backend!r}")
@@ -0,0 +1,85 @@
+"""
+Images prepared for uploading to the AI service providers.
+
+Scans from phones can be several megabytes, much more than the providers use: OpenAI looks at a low detail image at
+512 px, and Stability AI generates about a megapixel. The images are shrunk to what each provider uses and re-encoded
+before uploading, and kept in memory by the content hash of the source, so the repeated uploads of a generation are
+prepared once.
+"""
+import logging
+import math
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Tuple
+
+import cv2
+
+from .cache import file_digest
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_QUALITY = 90
+
+
+class UploadCache:
+    """
+    Prepared images in memory, least recently used first evicted when they take more than `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._images: "OrderedDict[Tuple, bytes]" = OrderedDict()
+        self._total_bytes = 0
+
+    def get(self, path: Path, max_side: int = 0, max_pixels: int = 0) -> bytes:
+        """
+        Return the image at `path` as a JPEG, shrunk to at most `max_side` px on the longest side and `max_pixels`
+        pixels, 0 for no limit. Never enlarged.
+        """
+        key = (file_digest(path), max_side, max_pixels)
+        with self._lock:
+            data = self._images.get(key)
+            if data is not None:
+                self._images.move_to_end(key)
+                return data
+
+        data = prepare_image(path, max_side, max_pixels)
+
+        with self._lock:
+            if key not in self._images:
+                self._images[key] = data
+                self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._total_bytes -= len(evicted)
+        return data
+
+
+def prepare_image(path: Path, max_side: int = 0, max_pixels: int = 0) -> bytes:
+    """Read the image at `path`, shrink it to the limits and return it as a JPEG."""
+    image = cv2.imread(str(path))
+    if image is None:
+        raise ValueError(f"Failed to read image {path}")
+
+    height, width = image.shape[:2]
+    scale = 1.0
+    if max_side:
+        scale = min(scale, max_side / max(height, width))
+    if max_pixels:
+        scale = min(scale, math.sqrt(max_pixels / (height * width)))
+    if scale < 1.0:
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    ok, encoded = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, UPLOAD_QUALITY])
+    if not ok:
+        raise ValueError(f"Failed to encode image {path}")
+    data = encoded.tobytes()
+
+    # A small original may already be smaller than the re-encoded image
+    if scale >= 1.0 and path.suffix.lower() in ('.jpg', '.jpeg') and path.stat().st_size <= len(data):
+        data = path.read_bytes()
+    logger.debug("Prepared %s for upload: %dx%d, %d bytes", path, image.shape[1], image.shape[0], len(data))
+    return data
@@ -0,0 +1,177 @@
+"""
+Durable append-only log of the votes.
+
+Votes are stored in an SQLite database in WAL mode. A single writer thread per process commits the votes queued by the
+request handlers in batches (group commit), so a burst of votes costs one transaction instead of one file open per vote.
+SQLite's file locking keeps the log consistent when several worker processes append to it at the same time.
+"""
+import csv
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import List, Literal, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Durability = Literal['off', 'normal', 'full']
+
+# SQLite `synchronous` pragma for each durability level
+SYNCHRONOUS = {
+    # Don't wait for the commit, and don't fsync. Votes may be lost if the process or machine crashes.
+    'off': 'OFF',
+    # Wait for the commit. Votes survive a process crash, the last ones may be lost on power failure.
+    'normal': 'NORMAL',
+    # Wait for the commit and fsync the log on every batch.
+    'full': 'FULL',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS votes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    img1 TEXT NOT NULL,
+    img2 TEXT NOT NULL,
+    winner TEXT NOT NULL,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS imports (
+    path TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL
+);
+"""
+
+# Logged vote: (id, image 1, image 2, winner)
+LoggedVote = Tuple[int, str, str, str]
+
+
+class VoteLog:
+    """
+    Vote log with batched commits.
+    """
+
+    def __init__(self, path: Path, durability: Durability = 'normal', batch_size: int = 512):
+        if durability not in SYNCHRONOUS:
+            raise ValueError(f"Unknown durability level {durability!r}")
+        self.path = Path(path)
+        self.durability = durability
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Optional[Tuple[tuple, Future]]]" = queue.Queue()
+        self._local = threading.local()
+        self._writer: Optional[threading.Thread] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(f"PRAGMA synchronous={SYNCHRONOUS[self.durability]}")
+        return conn
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Connection of the current thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def open(self) -> None:
+        """Create the database if needed, and start the writer thread."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn.executescript(SCHEMA)
+        self._writer = threading.Thread(target=self._write_batches, name="vote-log-writer", daemon=True)
+        self._writer.start()
+
+    def close(self) -> None:
+        """Commit the queued votes and stop the writer thread."""
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+
+    def append(self, img1: str, img2: str, winner: str, timestamp: Optional[float] = None) -> None:
+        """
+        Append a vote to the log.
+
+        Unless the durability level is 'off', waits until the batch containing the vote has been committed.
+        """
+        future = Future()
+        self._queue.put(((img1, img2, winner, timestamp or time.time()), future))
+        if self.durability != 'off':
+            future.result()
+
+    def _write_batches(self) -> None:
+        conn = self._connect()
+        stop = False
+        while not stop:
+            # Block for the first vote, then take whatever else has queued up meanwhile
+            batch = []
+            item = self._queue.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            else:
+                stop = True
+
+            if not batch:
+                continue
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.executemany("INSERT INTO votes (img1, img2, winner, timestamp) VALUES (?, ?, ?, ?)",
+                                 [row for row, _future in batch])
+                conn.execute("COMMIT")
+            except Exception as e:
+                logger.exception("Failed to commit %d votes", len(batch))
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                for _row, future in batch:
+                    future.set_exception(e)
+            else:
+                for _row, future in batch:
+                    future.set_result(None)
+        conn.close()
+
+    def read_since(self, last_id: int = 0) -> List[LoggedVote]:
+        """Return the votes with an id greater than `last_id`, in the order they were logged."""
+        return self._conn.execute(
+            "SELECT id, img1, img2, winner FROM votes WHERE id > ? ORDER BY id", (last_id,)
+        ).fetchall()
+
+    def last_id(self) -> int:
+        """Return the id of the last logged vote, or 0 if the log is empty."""
+        return self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM votes").fetchone()[0]
+
+    def import_csv(self, csv_path: Path) -> int:
+        """
+        Import the votes of a `vote_results.csv` file into the log.
+
+        Each file is imported only once, so this is safe to call on every startup and from every worker. Returns the
+        number of imported votes.
+        """
+        csv_path = Path(csv_path)
+        if not csv_path.exists():
+            return 0
+
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM imports WHERE path = ?", (str(csv_path.resolve()),)).fetchone():
+                conn.execute("ROLLBACK")
+                return 0
+            with open(csv_path, mode='r', newline='') as file:
+                reader = csv.DictReader(file)
+                rows = [(row['Image 1'], row['Image 2'], row['Winner'], float(row['Timestamp'])) for row in reader]
+            conn.executemany("INSERT INTO votes (img1, img2, winner, timestamp) VALUES (?, ?, ?, ?)", rows)
+            conn.execute("INSERT INTO imports (path, rows) VALUES (?, ?)", (str(csv_path.resolve()), len(rows)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        logger.info("Imported %d votes from %s", len(rows), csv_path)
+        return len(rows)
@@ -0,0 +1,296 @@
+"""
+In-memory index of the votes cast so far.
+
+The voting app used to re-read the whole vote log on every page load. The index is loaded once at startup and updated
+in place whenever a vote is recorded, so looking up how many times a pair has been shown is a dictionary access.
+
+Images are interned to integer ids, and only the pairs that have actually been voted on are stored. Pairs that have
+never been shown are sampled implicitly, so the memory and time used by the sampler grow with the number of voted pairs
+rather than with the square of the number of images. The weights of the voted pairs among the eligible images are kept
+in a `WeightedSampler`, so a draw takes O(log n) once the set of eligible images is known.
+"""
+import logging
+import threading
+from collections import deque
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from .sampling import WeightedSampler
+
+logger = logging.getLogger(__name__)
+
+# Vote count assumed for pairs that have not been voted on yet. Pairs are weighted by the inverse of their count.
+UNSEEN_PAIR_COUNT = 0.01
+
+# How many random draws to try before enumerating the unseen pairs explicitly
+MAX_REJECTIONS = 32
+
+
+class VoteIndex:
+    """
+    Counts how many times each (image 1, image 2) pair has been voted on.
+    """
+
+    def __init__(self, rng: Optional[np.random.Generator] = None):
+        self._lock = threading.Lock()
+        self._rng = rng or np.random.default_rng()
+        self.names: List[str] = []
+        self.ids: Dict[str, int] = {}
+        self.vote_count = 0
+
+        # Sparse pair counts: slot -> (image 1 id, image 2 id, count)
+        self._used = 0
+        self._slots: Dict[Tuple[int, int], int] = {}
+        # Slots of the pairs loaded by `restore()`, by their packed (image 1 id << 32 | image 2 id) keys in sorted order
+        self._restored_keys = np.zeros(0, dtype=np.int64)
+        self._restored_slots = np.zeros(0, dtype=np.int64)
+        self._pair_a = np.zeros(64, dtype=np.int64)
+        self._pair_b = np.zeros(64, dtype=np.int64)
+        self._counts = np.zeros(64, dtype=np.float64)
+
+        # Images that can currently be sampled, and the weights of the voted pairs among them
+        self._eligible_key: Hashable = None
+        self._eligible = np.zeros(0, dtype=np.int64)
+        self._is_eligible = np.zeros(0, dtype=bool)
+        self._eligible_seen = 0
+        self._seen = WeightedSampler(random=self._rng.random)
+
+    def intern(self, name: str) -> int:
+        """Return the integer id of image `name`, assigning a new one if needed."""
+        image_id = self.ids.get(name)
+        if image_id is None:
+            with self._lock:
+                image_id = self._intern(name)
+        return image_id
+
+    def _intern(self, name: str) -> int:
+        image_id = self.ids.get(name)
+        if image_id is None:
+            image_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = image_id
+        return image_id
+
+    def _add(self, img1: str, img2: str) -> None:
+        key = (self._intern(img1), self._intern(img2))
+        slot = self._find_slot(key)
+        if slot is None:
+            slot = self._used
+            self._used += 1
+            if slot == len(self._counts):
+                self._pair_a = np.concatenate([self._pair_a, np.zeros_like(self._pair_a)])
+                self._pair_b = np.concatenate([self._pair_b, np.zeros_like(self._pair_b)])
+                self._counts = np.concatenate([self._counts, np.zeros_like(self._counts)])
+            self._pair_a[slot], self._pair_b[slot] = key
+            self._slots[key] = slot
+            if self._is_pair_eligible(*key):
+                self._eligible_seen += 1
+        self._counts[slot] += 1
+        self.vote_count += 1
+        if self._is_pair_eligible(*key):
+            self._seen.set(slot, 1 / self._counts[slot])
+
+    def _find_slot(self, key: Tuple[int, int]) -> Optional[int]:
+        slot = self._slots.get(key)
+        if slot is None and len(self._restored_keys):
+            packed = key[0] << 32 | key[1]
+            i = int(np.searchsorted(self._restored_keys, packed))
+            if i < len(self._restored_keys) and self._restored_keys[i] == packed:
+                slot = int(self._restored_slots[i])
+        return slot
+
+    def _is_pair_eligible(self, img1: int, img2: int) -> bool:
+        mask = self._is_eligible
+        return img1 < len(mask) and img2 < len(mask) and mask[img1] and mask[img2]
+
+    def _set_eligible(self, eligible: np.ndarray, key: Hashable) -> None:
+        used = self._used
+        mask = np.zeros(len(self.names), dtype=bool)
+        mask[eligible] = True
+        seen = mask[self._pair_a[:used]] & mask[self._pair_b[:used]]
+
+        self._eligible_key = key
+        self._eligible = np.asarray(eligible, dtype=np.int64)
+        self._is_eligible = mask
+        self._eligible_seen = int(np.count_nonzero(seen))
+        self._seen.rebuild(np.where(seen, 1 / np.maximum(self._counts[:used], 1), 0.0))
+
+    def add(self, img1: str, img2: str) -> None:
+        """Record a single vote between `img1` and `img2`."""
+        with self._lock:
+            self._add(img1, img2)
+
+    def pair_count(self, img1: str, img2: str) -> int:
+        """Return how many votes the pair (`img1`, `img2`) has received."""
+        if img1 not in self.ids or img2 not in self.ids:
+            return 0
+        slot = self._find_slot((self.ids[img1], self.ids[img2]))
+        if slot is None:
+            return 0
+        return int(self._counts[slot])
+
+    def add_many(self, votes: Iterable[Tuple[str, str, str]]) -> None:
+        """Record many (image 1, image 2, winner) votes at once."""
+        with self._lock:
+            for img1, img2, _winner in votes:
+                self._add(img1, img2)
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """Return copies of the arrays the index is made of, for saving in a snapshot."""
+        with self._lock:
+            used = self._used
+            return {
+                'names': np.array(self.names, dtype=str),
+                'pair_a': self._pair_a[:used].copy(),
+                'pair_b': self._pair_b[:used].copy(),
+                'counts': self._counts[:used].copy(),
+            }
+
+    def restore(self, names: np.ndarray, pair_a: np.ndarray, pair_b: np.ndarray, counts: np.ndarray) -> None:
+        """Replace the contents of the index with a `state()` saved earlier."""
+        used = len(counts)
+        size = max(64, 1 << max(used - 1, 0).bit_length())
+        with self._lock:
+            self.names = names.tolist()
+            self.ids = {name: image_id for image_id, name in enumerate(self.names)}
+            self.vote_count = int(counts.sum())
+
+            # Sorting the packed keys is much faster than building a dictionary of millions of pairs
+            keys = pair_a.astype(np.int64) << 32 | pair_b.astype(np.int64)
+            order = np.argsort(keys)
+            self._used = used
+            self._slots = {}
+            self._restored_keys = keys[order]
+            self._restored_slots = order
+            self._pair_a = np.zeros(size, dtype=np.int64)
+            self._pair_b = np.zeros(size, dtype=np.int64)
+            self._counts = np.zeros(size, dtype=np.float64)
+            self._pair_a[:used] = pair_a
+            self._pair_b[:used] = pair_b
+            self._counts[:used] = counts
+
+            self._eligible_key = None
+            self._eligible = np.zeros(0, dtype=np.int64)
+            self._is_eligible = np.zeros(0, dtype=bool)
+            self._eligible_seen = 0
+            self._seen.rebuild(())
+
+    def sample_pair(self, eligible: np.ndarray, key: Hashable = None) -> Tuple[int, int]:
+        """
+        Sample an ordered pair of distinct image ids from `eligible`.
+
+        Each pair is chosen with probability proportional to the inverse of its vote count, so pairs that have been
+        voted on less are more likely to be shown. Raises `ValueError` if there are fewer than two eligible images.
+
+        `key` identifies the set of eligible images. The pair weights are only recomputed when it changes, or on every
+        call if it is None.
+        """
+        with self._lock:
+            if key is None or key != self._eligible_key:
+                self._set_eligible(eligible, key)
+
+            n = len(self._eligible)
+            if n < 2:
+                raise ValueError("At least two images are needed for a pair")
+
+            seen_total = max(self._seen.total, 0.0) if self._eligible_seen else 0.0
+            unseen_total = (n * (n - 1) - self._eligible_seen) / UNSEEN_PAIR_COUNT
+            if self._rng.random() * (seen_total + unseen_total) < unseen_total:
+                return self._sample_unseen_pair()
+
+            slot = self._seen.sample()
+            return int(self._pair_a[slot]), int(self._pair_b[slot])
+
+    def _sample_unseen_pair(self) -> Tuple[int, int]:
+        """Sample uniformly a pair of eligible images that has not been voted on."""
+        eligible = self._eligible
+        n = len(eligible)
+        for _ in range(MAX_REJECTIONS):
+            i, j = self._rng.choice(n, size=2, replace=False)
+            pair = int(eligible[i]), int(eligible[j])
+            if self._find_slot(pair) is None:
+                return pair
+
+        # Most pairs have been voted on, enumerate the remaining ones
+        used = self._used
+        pair_a = self._pair_a[:used]
+        pair_b = self._pair_b[:used]
+        seen = self._is_eligible[pair_a] & self._is_eligible[pair_b]
+        positions = np.full(len(self._is_eligible), -1, dtype=np.int64)
+        positions[eligible] = np.arange(n)
+        unseen = ~np.eye(n, dtype=bool)
+        unseen[positions[pair_a[seen]], positions[pair_b[seen]]] = False
+        i, j = np.divmod(self._rng.choice(np.flatnonzero(unseen)), n)
+        return int(eligible[i]), int(eligible[j])
+
+
+class PairQueue:
+    """
+    Bounded queue of pre-sampled pairs, kept full by a background thread.
+
+    `sample()` returns a new pair, and `state()` returns a key that changes whenever the set of images that can be
+    sampled changes. Pairs sampled under an old key are discarded, so the queue never hands out stale images.
+    """
+
+    def __init__(self, sample: Callable[[], Tuple[str, str]], state: Callable[[], Hashable], size: int = 32):
+        self.sample = sample
+        self.state = state
+        self.size = size
+        self._pairs = deque()
+        self._key: Hashable = None
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self) -> None:
+        self._stopped = False
+        self._thread = threading.Thread(target=self._fill, name="pair-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def pop(self) -> Optional[Tuple[str, str]]:
+        """Return a pre-sampled pair, or None if none is available for the current state."""
+        key = self.state()
+        with self._cond:
+            if key != self._key:
+                self._pairs.clear()
+                self._key = key
+            pair = self._pairs.popleft() if self._pairs else None
+            if len(self._pairs) <= self.size // 2:
+                self._cond.notify()
+        return pair
+
+    def _fill(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped and len(self._pairs) > self.size // 2:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+            key = self.state()
+            pairs = []
+            try:
+                while len(pairs) < self.size:
+                    pairs.append(self.sample())
+            except ValueError:
+                # Not enough images yet, retry after a while unless woken up earlier
+                pass
+            except Exception:
+                logger.exception("Failed to sample pairs")
+
+            with self._cond:
+                if key != self._key:
+                    self._pairs.clear()
+                    self._key = key
+                self._pairs.extend(pairs[:self.size - len(self._pairs)])
+                if len(pairs) < self.size:
+                    self._cond.wait(timeout=1)
@@ -1,33 +1,96 @@
+import base64
 import logging
 from pathlib import Path
-from typing import Counter, List
-from fastapi import FastAPI, HTTPException
+from typing import Dict, List, Optional, Tuple
+from fastapi import FastAPI, HTTPException, Query
 from pydantic import BaseModel
-import csv
-import os
 import time
 import random
+import secrets
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from .app import create_app, get_pkg_path, settings
+from .catalog import FilteredCatalog, ImageCatalog, ImageInfo, Snapshot
+from .events import Feed
+from .metrics import PAGE_VIEWS, VOTES
 from .models import Vote
-from fastapi.responses import HTMLResponse, JSONResponse
+from .moderation import ModerationQueue, Status
+from .ratings import Ratings
+from .renditions import FORMATS, SIZES, RenditionStore
+from .sampling import KeyedSampler, RecencyWeight
+from .snapshots import VoteSnapshot, load_snapshot, save_snapshot
+from .tokens import create_token_store
+from .votelog import VoteLog
+from .votes import PairQueue, VoteIndex
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from fastapi import FastAPI, Request
+from fastapi import Depends, FastAPI, Header, Request, Response
 
 logger = logging.getLogger(__name__)
 app = create_app()
 
-# Path to the CSV file where the votes will be stored
+# Path to the database where the votes will be stored, and to the CSV file votes used to be stored in
+VOTE_LOG_PATH = Path(settings.INSTANCE_PATH) / 'votes.sqlite'
+VOTE_SNAPSHOT_PATH = Path(settings.INSTANCE_PATH) / 'votes.snapshot.npz'
 CSV_FILE_PATH = Path(settings.INSTANCE_PATH) / 'vote_results.csv'
 MODERATION_FILE_PATH = Path(settings.INSTANCE_PATH) / 'accepted.csv'
 IMAGES_DIR = Path(settings.INSTANCE_PATH) / 'generated'
+ORIGINALS_DIR = Path(settings.INSTANCE_PATH) / 'original'
+RENDITIONS_DIR = Path(settings.INSTANCE_PATH) / 'renditions'
 STATIC_DIR = get_pkg_path() / 'static'
 TEMPLATES_DIR = get_pkg_path() / 'templates'
 
 # Stores random uuids to prevent repeat voting
-current_voting_tokens = {}
+current_voting_tokens = create_token_store(
+    settings.VOTE_TOKEN_BACKEND,
+    Path(settings.INSTANCE_PATH) / 'tokens.sqlite',
+    ttl=settings.VOTE_TOKEN_TTL,
+    max_size=settings.VOTE_TOKEN_MAX,
+)
+
+# Pair counts and image ratings of the votes so far, loaded at startup
+vote_log = VoteLog(VOTE_LOG_PATH, durability=settings.VOTE_LOG_DURABILITY)
+vote_index = VoteIndex()
+ratings = Ratings(k_factor=settings.RATING_K_FACTOR)
+
+# Moderation status of the generated images
+moderation = ModerationQueue(MODERATION_FILE_PATH, required=settings.MODERATION_REQUIRED)
+
+# Listing of all the generated images, and of the ones that passed moderation, which is what the pages show
+all_images = ImageCatalog(IMAGES_DIR)
+catalog = FilteredCatalog(all_images, moderation.is_visible, refresh_filter=moderation.refresh)
+
+# Resized images, and the directories they can be made from by the name used in their URLs
+renditions = RenditionStore(RENDITIONS_DIR, max_bytes=settings.RENDITION_CACHE_BYTES)
+rendition_sources = {'generated': IMAGES_DIR, 'original': ORIGINALS_DIR}
+rendition_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="renditions")
+
+# Image names weighted by how recently they were modified, for the display pages
+recent_images = KeyedSampler()
+recency_weight = RecencyWeight(settings.PAIR_RECENCY_HALF_LIFE)
+recent_images_lock = threading.Lock()
+
+# Vote index ids of the catalog images, oldest first by creation time: (catalog version, ids)
+created_ids = (0, np.zeros(0, dtype=np.int64))
+
+# Id of the last logged vote applied to the vote index and ratings
+last_vote_id = 0
+last_vote_sync = 0.0
+vote_sync_lock = threading.Lock()
+
+# Id of the last vote included in the latest snapshot of the vote index and ratings
+snapshot_vote_id = 0
+# Snapshots are written one at a time, in the order they were taken
+snapshot_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="vote-snapshot")
+
+# Seconds between picking up the votes logged by other workers on page loads
+VOTE_SYNC_INTERVAL = 1.0
+
+# Images become eligible for voting this many seconds after they were created
+MIN_IMAGE_AGE = 120
 
 # Headlines for the voting page
 headlines = [
@@ -91,16 +154,109 @@ voting_responses = [
 
 @app.on_event("startup")
 def startup_event():
-    # Ensure CSV file exists and has the header
-    if not os.path.exists(CSV_FILE_PATH):
-        with open(CSV_FILE_PATH, mode='w') as file:
-            writer = csv.writer(file)
-            writer.writerow(['Image 1', 'Image 2', 'Winner', 'Timestamp'])  # Write header if the file is created
+    # Open the vote log, importing the votes of the old CSV file once
+    vote_log.open()
+    vote_log.import_csv(CSV_FILE_PATH)
+    load_votes()
+
+    moderation.open()
+    all_images.add_listener(prerender_renditions)
+    all_images.add_listener(moderation.update_images)
+    catalog.add_listener(update_recent_images)
+    catalog.open()
+    pair_queue.start()
+
+
+@app.on_event("shutdown")
+def shutdown_event():
+    pair_queue.stop()
+    with vote_sync_lock:
+        if settings.VOTE_SNAPSHOT_INTERVAL and last_vote_id != snapshot_vote_id:
+            snapshot = VoteSnapshot(last_vote_id, vote_index.state(), ratings.state())
+            snapshot_executor.submit(write_vote_snapshot, snapshot)
+    snapshot_executor.shutdown(wait=True)
+    vote_log.close()
+    catalog.close()
+    rendition_executor.shutdown(cancel_futures=True)
+
+
+def sync_votes(max_age: float = 0) -> None:
+    """
+    Apply the votes logged since the last sync to the vote index and ratings.
+
+    Other worker processes append to the same log, so this also picks up their votes. The sync is skipped if the
+    previous one was less than `max_age` seconds ago.
+    """
+    global last_vote_id, last_vote_sync
+
+    if time.monotonic() - last_vote_sync < max_age:
+        return
+    with vote_sync_lock:
+        votes = vote_log.read_since(last_vote_id)
+        for _id, img1, img2, winner in votes:
+            vote_index.add(img1, img2)
+            ratings.update(winner, img2 if winner == img1 else img1)
+        if votes:
+            last_vote_id = votes[-1][0]
+        last_vote_sync = time.monotonic()
+        schedule_vote_snapshot()
+
+
+def load_votes() -> None:
+    """
+    Load the vote index and ratings from the latest snapshot, and replay the votes logged after it.
+
+    Without a usable snapshot the whole vote log is replayed, and the ratings are fitted from scratch.
+    """
+    global last_vote_id, snapshot_vote_id
+
+    snapshot = load_snapshot(VOTE_SNAPSHOT_PATH)
+    if snapshot is not None and snapshot.last_vote_id > vote_log.last_id():
+        logger.warning("Vote snapshot %s is ahead of the vote log, removing it", VOTE_SNAPSHOT_PATH)
+        # Removed, as it would keep the snapshots of the current log from replacing it
+        VOTE_SNAPSHOT_PATH.unlink(missing_ok=True)
+        snapshot = None
+
+    if snapshot is None:
+        votes = vote_log.read_since(0)
+        vote_index.add_many((img1, img2, winner) for _id, img1, img2, winner in votes)
+        ratings.rebuild(
+            winners=[winner for _id, _img1, _img2, winner in votes],
+            losers=[img2 if winner == img1 else img1 for _id, img1, img2, winner in votes],
+        )
+        with vote_sync_lock:
+            if votes:
+                last_vote_id = votes[-1][0]
+            schedule_vote_snapshot()
+    else:
+        vote_index.restore(**snapshot.index)
+        ratings.restore(**snapshot.ratings)
+        last_vote_id = snapshot_vote_id = snapshot.last_vote_id
+        sync_votes()
+        logger.info("Loaded vote snapshot up to vote %d, replayed the votes up to %d", snapshot_vote_id, last_vote_id)
+
+
+def schedule_vote_snapshot() -> None:
+    """
+    Snapshot the vote index and ratings in the background if enough votes have been applied since the last snapshot.
+
+    Must be called with `vote_sync_lock` held, so the snapshot matches `last_vote_id`.
+    """
+    global snapshot_vote_id
+
+    interval = settings.VOTE_SNAPSHOT_INTERVAL
+    if not interval or last_vote_id - snapshot_vote_id < interval:
+        return
+    snapshot = VoteSnapshot(last_vote_id, vote_index.state(), ratings.state())
+    snapshot_vote_id = last_vote_id
+    snapshot_executor.submit(write_vote_snapshot, snapshot)
+
 
-    if not os.path.exists(MODERATION_FILE_PATH):
-        with open(MODERATION_FILE_PATH, mode='w') as file:
-            writer = csv.writer(file)
-            writer.writerow(['filename', 'status'])  # Write header if the file is created
+def write_vote_snapshot(snapshot: VoteSnapshot) -> None:
+    try:
+        save_snapshot(VOTE_SNAPSHOT_PATH, snapshot)
+    except Exception:
+        logger.exception("Failed to save vote snapshot %s", VOTE_SNAPSHOT_PATH)
 
 
 # Pydantic model for vote data validation
@@ -112,16 +268,80 @@ class Vote(BaseModel):
 
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.mount("/generated_images", StaticFiles(directory=IMAGES_DIR), name="generated_images")
-app.mount("/original_images", StaticFiles(directory=Path(settings.INSTANCE_PATH) / 'original'), name="original_images")
+app.mount("/original_images", StaticFiles(directory=ORIGINALS_DIR), name="original_images")
+
+
+def rendition_url(url: str, size: int) -> str:
+    """
+    Return the URL of the `size` px rendition of an image URL under /generated_images or /original_images.
+    """
+    for source, prefix in (('generated', '/generated_images/'), ('original', '/original_images/')):
+        if url.startswith(prefix):
+            return f"/renditions/{source}/{size}/{url[len(prefix):]}"
+    return url
+
 
 templates = Jinja2Templates(directory=TEMPLATES_DIR)
+templates.env.globals['rendition'] = rendition_url
+
+
+def prerender_renditions(snapshot: Snapshot, changed: set) -> None:
+    """
+    Make the gallery renditions of new and changed generated images in the background.
+    """
+    for name in changed:
+        if name in snapshot:
+            rendition_executor.submit(renditions.get, IMAGES_DIR / name, 512, 'webp')
+
+
+@app.get('/renditions/{source}/{size}/{filename}')
+def get_rendition(request: Request, source: str, size: int, filename: str, format: Optional[str] = None):
+    """
+    Returns the image resized so that its longest side is `size` px.
+
+    The image is WebP if the browser accepts it and JPEG otherwise, unless `format` is given.
+    """
+    directory = rendition_sources.get(source)
+    if directory is None or size not in SIZES or filename != Path(filename).name or filename.startswith('.'):
+        raise HTTPException(status_code=404, detail="Not found")
+    path = directory / filename
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+
+    fmt = format or ('webp' if 'image/webp' in request.headers.get('accept', '') else 'jpeg')
+    if fmt not in FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {fmt!r}")
+
+    try:
+        digest = renditions.content_hash(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+    headers = {
+        "ETag": f'"{digest[:32]}-{size}-{fmt}"',
+        "Cache-Control": "public, max-age=300",
+        "Vary": "Accept",
+    }
+    if request.headers.get('if-none-match') == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+
+    try:
+        target, _digest = renditions.get(path, size, fmt)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Not found")
+    except ValueError as e:
+        # Images being written to the directory can't be read until they are complete
+        logger.info("No rendition of %s: %s", path, e)
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(target, media_type=FORMATS[fmt][1], headers=headers)
 
 @app.get("/", response_class=HTMLResponse)
 def index(request: Request):
+    PAGE_VIEWS.inc(page='vote')
+    sync_votes(max_age=VOTE_SYNC_INTERVAL)
+
     # Attempt to get images for voting, and handle case where no images are available
-    images = get_biased_pair()
     try:
-        images = get_biased_pair()
+        images = pair_queue.pop() or get_biased_pair()
     except ValueError as _:
         return templates.TemplateResponse(
             "front.html", 
@@ -141,7 +361,7 @@ def index(request: Request):
     vote_token = str(uuid.uuid4())
     img1_name = images[0].split("/")[-1]
     img2_name = images[1].split("/")[-1]
-    current_voting_tokens[vote_token] = [img1_name, img2_name]
+    current_voting_tokens.issue(vote_token, (img1_name, img2_name))
 
     # Random headline and corresponding vote response
     headline = random.choice(headlines)
@@ -166,21 +386,27 @@ def index(request: Request):
 @app.post('/vote')
 def vote(vote: Vote):
    try:
-        # Check vote validity
-        if vote.vote_token not in current_voting_tokens:
+        # Check vote validity. The token is used up even if the vote is invalid.
+        pair = current_voting_tokens.redeem(vote.vote_token)
+        if pair is None:
+            VOTES.inc(result='invalid_token')
             raise HTTPException(status_code=400, detail="Invalid vote")
         if vote.winner not in [vote.img1, vote.img2]:
+            VOTES.inc(result='invalid')
             raise HTTPException(status_code=400, detail="Invalid vote")
-        if vote.img1 != current_voting_tokens[vote.vote_token][0] or vote.img2 != current_voting_tokens[vote.vote_token][1]:
+        if vote.img1 != pair[0] or vote.img2 != pair[1]:
+            VOTES.inc(result='invalid')
             raise HTTPException(status_code=400, detail="Invalid vote")
         
-        # Append the vote to the CSV file
-        with open(CSV_FILE_PATH, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([vote.img1, vote.img2, vote.winner, str(time.time())])
-            current_voting_tokens.pop(vote.vote_token)
+        # Append the vote to the vote log
+        vote_log.append(vote.img1, vote.img2, vote.winner)
+        sync_votes()
+        VOTES.inc(result='ok')
         return f"Voted for {vote.winner}!"
+   except HTTPException:
+        raise
    except Exception as e:
+        VOTES.inc(result='error')
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get('/test_page')
@@ -188,15 +414,10 @@ def test_page(request: Request):
     """"
     Returns the winner
     """
+    PAGE_VIEWS.inc(page='winner')
     try:
-        rows = []
-        with open(CSV_FILE_PATH, mode='r') as file:
-            reader = csv.DictReader(file)
-            for row in reader:
-                rows.append(row)
-        # Count the number of wins for each image
-        votes = Counter(row['Winner'] for row in rows)
-        winner_id, _votes = votes.most_common(1)[0]
+        # Find the image with the most wins
+        winner_id = ratings.names[int(np.argmax(ratings.wins[:len(ratings)]))]
 
         # Return the winner image and id
         return templates.TemplateResponse(
@@ -211,150 +432,177 @@ def test_page(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def get_created_ids(snapshot: Snapshot) -> np.ndarray:
+    """
+    Return the vote index ids of the images in `snapshot`, oldest first by creation time.
+    """
+    global created_ids
+
+    version, ids = created_ids
+    if version != snapshot.version:
+        names = snapshot.created_names
+        ids = np.fromiter((vote_index.intern(name) for name in names), dtype=np.int64, count=len(names))
+        created_ids = (snapshot.version, ids)
+    return ids
+
+
 def get_biased_pair():
     """
     Read the votes, and use biased sampling to return a pair of images.
     """
-    # Get the full list of all generated images
-    images = list(Path(IMAGES_DIR).glob('*'))
-    image_paths = [f"/generated_images/{img.name}" for img in images]
+    snapshot = catalog.snapshot()
 
     # Filter out images that have their creation time less than 2 minutes ago
-    image_paths = [img for img in image_paths if time.time() - os.path.getctime(IMAGES_DIR / img.split("/")[-1]) > 120]
-    
-    # Create a matrix to hold votes, and a corresponding matrix to hold related pairs of images.
-    # Matrix cells are in same order as in the image_names variable (left to right, top to bottom)
-    image_names = [i.split("/")[-1] for i in image_paths]
-    vote_matrix = np.full((len(image_names), len(image_names)), 0.01)
-    np.fill_diagonal(vote_matrix, 0)
-    
-    pair_matrix = np.empty((len(image_names), len(image_names)), dtype=object)
-    for y in list(range(0, len(image_names))):
-        for x in list(range(0, len(image_names))):
-            pair_matrix[y, x] = (image_names[y], image_names[x])
-
-    # Read the votes so far, and fill the vote matrix correspondingly
-    vote_count = 0
-    with open(CSV_FILE_PATH, mode='r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            try:
-                x_index = image_names.index(row['Image 1'])
-                y_index = image_names.index(row['Image 2'])
-                if vote_matrix[x_index, y_index] < 1:
-                    vote_matrix[x_index, y_index] = 1
-                else:
-                    vote_matrix[x_index, y_index] += 1
-                vote_count += 1
-            except ValueError as _:
-                pass
-
-    # Create a new array that has all cells from matrix EXCEPT the diagonal (cant choose between same image)
-    # Remove the diagonal from flattened matrix, and remove corresponding pairs from the pair matrix
-    flat_vote_matrix = vote_matrix.flatten()
-    flat_pair_matrix = pair_matrix.flatten()
-    remove_indexes = np.ones(flat_vote_matrix.shape, dtype=bool)
-    for index, value in enumerate(flat_vote_matrix):
-        if value == 0:
-            remove_indexes[index] = False
-    flat_vote_matrix = flat_vote_matrix[remove_indexes]
-    flat_pair_matrix = flat_pair_matrix[remove_indexes]
-
-    # Without votes, use unbiased sampling
-    if vote_count == 0:
-        unbiased_pair = np.random.choice(image_paths, [1,2], replace=False)
-        return unbiased_pair[0]
-    
-    # Add an extra element that makes sure even the most voted item has a small chance of appearing in a vote
-    most_voted = np.max(flat_vote_matrix)
-    flat_vote_matrix = np.insert(flat_vote_matrix, 0, most_voted + 1, axis=0)
-    flat_pair_matrix = np.insert(flat_pair_matrix, 0, 0, axis=0)
-    
-    # Calculate the weights for choosing the biased pair
-    inverse_counts = 1 / flat_vote_matrix
-    weights = inverse_counts / inverse_counts.sum()
-    
-    # Select a pair of images using the biased sampling distribution
-    biased_pair = np.random.choice(flat_pair_matrix, p=weights, replace=False)
-
-    # In case the extra element is actually chosen, choose again (the extra element is just 0)
-    while not biased_pair:
-        biased_pair = np.random.choice(flat_pair_matrix, p=weights, replace=False)
+    eligible = get_created_ids(snapshot)[:snapshot.created_before(time.time() - MIN_IMAGE_AGE)]
+
+    # Sample a pair of image ids, less voted pairs being more likely
+    img1, img2 = vote_index.sample_pair(eligible, key=(snapshot.version, len(eligible)))
 
     # Return the result
-    return (f"/generated_images/{biased_pair[0]}", f"/generated_images/{biased_pair[1]}")
-
-
-# @app.get('/moderation')
-# def moderation(request: Request):
-#     # Get the full list of all generated images
-#     images = list(Path(IMAGES_DIR).glob('*'))
-#     image_paths = [f"/generated_images/{img.name}" for img in images]
-
-#     # Read the votes so far, and fill the vote matrix correspondingly
-#     with open(MODERATION_FILE_PATH, mode='r') as file:
-#         reader = csv.DictReader(file)
-#         for row in reader:
-#             x_index = image_names.index(row['Image 1'])
-#             y_index = image_names.index(row['Image 2'])
-#             if vote_matrix[x_index, y_index] < 1:
-#                 vote_matrix[x_index, y_index] = 1
-#             else:
-#                 vote_matrix[x_index, y_index] += 1
-#             vote_count += 1
-
-
-# @app.get('/get_next_unmoderated')
-# def get_next_unmoderated():
-#     """
-#     Returns a single file that is unmoderated
-#     """
-#     images = list(Path(IMAGES_DIR).glob('*'))
-#     image_paths = [f"/generated_images/{img.name}" for img in images]
-
-#     # Find the filepaths that are not yet in the moderation file
-#     accepted_dict = {}
-#     with open(MODERATION_FILE_PATH, mode='r') as file:
-#         reader = csv.DictReader(file)
-#         for row in reader:
-#             accepted_dict[row['filename']] = row["status"]
-
-#     for image in image_paths:
-
-#     return image_paths
+    return (f"/generated_images/{vote_index.names[img1]}", f"/generated_images/{vote_index.names[img2]}")
+
+
+def get_eligibility_state():
+    """
+    Return a key that changes whenever the images eligible for `get_biased_pair` change.
+    """
+    snapshot = catalog.snapshot()
+    return snapshot.version, snapshot.created_before(time.time() - MIN_IMAGE_AGE)
+
+
+# Pairs sampled ahead of the page loads
+pair_queue = PairQueue(get_biased_pair, get_eligibility_state)
+
+
+class ModerationDecisions(BaseModel):
+    accepted: List[str] = []
+    rejected: List[str] = []
+    pending: List[str] = []
+
+
+def require_moderator(authorization: Optional[str] = Header(None)) -> None:
+    """
+    Checks the `Authorization: Bearer <MODERATION_TOKEN>` header of the moderation requests.
+    """
+    if not settings.MODERATION_TOKEN:
+        raise HTTPException(status_code=403, detail="Moderation is disabled")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(token.encode(), settings.MODERATION_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Invalid moderation token", headers={"WWW-Authenticate": "Bearer"})
+
+
+@app.get('/moderation/next', dependencies=[Depends(require_moderator)])
+def get_next_unmoderated(limit: int = Query(1, ge=1, le=500)):
+    """
+    Returns the images waiting for moderation, oldest first.
+    """
+    catalog.refresh()
+    return {
+        "images": [f"/generated_images/{name}" for name in moderation.next_pending(limit)],
+        "counts": moderation.counts(),
+    }
+
+
+@app.post('/moderation', dependencies=[Depends(require_moderator)])
+def moderate(decisions: ModerationDecisions):
+    """
+    Accepts or rejects a batch of images, or returns them to the moderation queue.
+    """
+    existing = all_images.snapshot()
+    statuses: Dict[str, Status] = {}
+    for status in ('pending', 'accepted', 'rejected'):
+        for name in getattr(decisions, status):
+            name = name.removeprefix('/generated_images/')
+            if name not in existing:
+                raise HTTPException(status_code=404, detail=f"Unknown image {name}")
+            statuses[name] = status
+    try:
+        changed = moderation.set_statuses(statuses)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    catalog.invalidate(changed)
+    return {"changed": sorted(changed), "counts": moderation.counts()}
+
+
+def update_recent_images(snapshot: Snapshot, changed: set) -> None:
+    """
+    Update the recency weights of the changed images.
+    """
+    with recent_images_lock:
+        for name in changed:
+            image = snapshot.by_name.get(name)
+            if image is None:
+                recent_images.remove(name)
+            else:
+                recent_images.set(name, recency_weight(image.mtime))
+
+
+def sample_recent_pair() -> Optional[dict]:
+    """
+    Select two images, favouring the recently modified ones. Returns None if there are fewer than two images.
+    """
+    catalog.refresh()
+    with recent_images_lock:
+        if len(recent_images) < 2:
+            return None
+        image1, image2 = recent_images.sample_distinct(2)
+    return {"image1": f"/generated_images/{image1}", "image2": f"/generated_images/{image2}"}
+
+
+def latest_pair() -> Optional[dict]:
+    """
+    Return the two most recently modified images, or None if there are fewer than two.
+    """
+    images = catalog.snapshot().images
+    if len(images) < 2:
+        return None
+    return {
+        "image1": f"/generated_images/{images[0].name}",
+        "image2": f"/generated_images/{images[1].name}",
+    }
+
+
+# Event feeds of the display pages. The pair feed ticks at the pace of the slideshow.
+feeds = {
+    'pair': Feed('pair', sample_recent_pair, interval=20),
+    'latest': Feed('latest', latest_pair, interval=1, only_changes=True),
+}
+
 
 @app.get('/pair.json')
 def get_image_pair():
-    
-    weights = []
-    images = []
-    for image in Path(IMAGES_DIR).glob('*'):
-        images.append(f"/generated_images/{image.name}")
-        # file modification time in seconds
-        mtime = os.path.getmtime(image)
-        # current time in seconds
-        weights.append(mtime)
-
-    # normalize weights
-    weights = np.array(weights)
-    weights = weights - weights.min()
-    weights = weights / weights.sum()
-    # Select two images with probability proportional to the time since last modification
-    pair = np.random.choice(images, size=2, replace=False, p=weights/weights.sum())
-    
-    response = JSONResponse(content={"image1": pair[0], "image2": pair[1]})
+    pair = sample_recent_pair()
+    if pair is None:
+        raise HTTPException(status_code=404, detail="Not enough images")
+    response = JSONResponse(content=pair)
     response.headers["Cache-Control"] = "max-age=17"
 
     return response
 
 
+@app.get('/events/{feed}')
+async def get_events(feed: str):
+    """
+    Server-Sent Events stream of the `pair` or `latest` feed, shared by all displays.
+    """
+    if feed not in feeds:
+        raise HTTPException(status_code=404, detail="Unknown feed")
+    return StreamingResponse(
+        feeds[feed].subscribe(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get('/fullscreen')
 def page_fs(request: Request):
+    PAGE_VIEWS.inc(page='fullscreen')
     response = templates.TemplateResponse(
         name="fullscreen.html", 
         context={
             "request": request,
-            "json": "pair.json"
+            "json": "pair.json",
+            "feed": "pair"
         }
     )
     return response
@@ -362,20 +610,23 @@ def page_fs(request: Request):
 
 @app.get('/latest')
 def page_latest(request: Request):
+    PAGE_VIEWS.inc(page='latest')
     response = templates.TemplateResponse(
         name="fullscreen.html", 
         context={
             "request": request,
-            "json": "latest.json"
+            "json": "latest.json",
+            "feed": "latest"
         }
     )
     return response
 
 @app.get('/latest.json')
 def get_latest():
-    images = list(Path(IMAGES_DIR).glob('*'))
-    images = sorted(images, key=os.path.getmtime, reverse=True)
-    response = JSONResponse(content={"image1": str(images[0]), "image2": str(images[1])})
+    pair = latest_pair()
+    if pair is None:
+        raise HTTPException(status_code=404, detail="Not enough images")
+    response = JSONResponse(content=pair)
     return response
 
 @app.get('/gallery')
@@ -384,6 +635,7 @@ def gallery(request: Request):
     Returns a list of all images in the generated_images.
     Include all image type files
     """
+    PAGE_VIEWS.inc(page='gallery')
     response = templates.TemplateResponse(
         name="gallery.html", 
         context={
@@ -395,17 +647,48 @@ def gallery(request: Request):
 
     return response
 
+def encode_cursor(image: ImageInfo) -> str:
+    """Return an opaque pagination cursor pointing to `image`."""
+    return base64.urlsafe_b64encode(f"{image.mtime_ns}:{image.name}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Return the (mtime_ns, name) key of a cursor made by `encode_cursor`."""
+    try:
+        mtime_ns, name = base64.urlsafe_b64decode(cursor.encode()).decode().split(":", 1)
+        return int(mtime_ns), name
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from e
+
+
 @app.get('/get_all_images')
-def get_all_images():
+def get_all_images(
+    cursor: Optional[str] = None,
+    limit: int = Query(60, ge=1, le=500),
+    if_none_match: Optional[str] = Header(None),
+):
     """
-    Returns a list of all images in the generated_images.
-    Include all image type files
+    Returns a page of the images in the generated_images, newest first.
+
+    Pass the returned `next_cursor` as `cursor` to get the next page. It is null on the last page.
     """
-    images = list(Path(IMAGES_DIR).glob('*'))
+    snapshot = catalog.snapshot()
+
+    # The page only changes when the catalog does
+    etag = f'"{snapshot.etag}"'
+    if if_none_match and (if_none_match.strip() == "*"
+                          or etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    images = snapshot.page(after=decode_cursor(cursor) if cursor else None, limit=limit + 1)
+    next_cursor = encode_cursor(images[limit - 1]) if len(images) > limit else None
 
     # Compare the list of images to list of accepted images
-    image_paths = [f"/generated_images/{img.name}" for img in images]
-    return image_paths
+    image_paths = [f"/generated_images/{img.name}" for img in images[:limit]]
+    response = JSONResponse(content={"images": image_paths, "next_cursor": next_cursor})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return response
 
 @app.get("/ga")
 
@@ -414,32 +697,35 @@ class VoteResult(BaseModel):
     wins: int
     losses: int
     relative_votes: float
+    rating: float
 
 @app.get('/scores.json')
-def get_scores() -> List[VoteResult]:
+def get_scores(limit: Optional[int] = None, offset: int = 0) -> List[VoteResult]:
     """
-    Returns the scores of votes.
+    Returns the scores of votes, from the highest rated image to the lowest.
+
+    Use `limit` and `offset` to get a single page of the leaderboard.
     """
-    wins = Counter()
-    displays = Counter()
+    existing = catalog.snapshot()
     r = []
 
-    with open(CSV_FILE_PATH, mode='r') as file:
-        reader = csv.DictReader(file)
-        for row in reader:
-            wins[row['Winner']] += 1
-            displays[row['Image 1']] += 1
-            displays[row['Image 2']] += 1
-
-    for image in displays:
-        if not Path(IMAGES_DIR / image).exists():
-            logger.debug(f"Image {image} does not exist") 
+    position = 0
+    for image_id in ratings.ranking():
+        if limit is not None and len(r) >= limit:
+            break
+        score = ratings.get(image_id)
+        if score.image not in existing:
+            logger.debug(f"Image {score.image} does not exist")
+            continue
+        position += 1
+        if position <= offset:
             continue
         r.append(VoteResult(
-            image=image,
-            wins=wins[image],
-            losses=displays[image] - wins[image],
-            relative_votes=wins[image] / displays[image]
+            image=score.image,
+            wins=score.wins,
+            losses=score.displays - score.wins,
+            relative_votes=score.wins / score.displays if score.displays else 0.0,
+            rating=score.rating
         ))
 
     return r
@@ -457,12 +743,12 @@ def results(request: Request):
     """
     Returns the results of the votes.
     """
+    PAGE_VIEWS.inc(page='results')
     # results = get_scores()
     # results = sort_by_results(results)
 
-    images = list(Path(IMAGES_DIR).glob('*'))
-    # Sort images by creation time
-    images = sorted(images, key=os.path.getmtime, reverse=True)
+    # Images sorted by modification time, newest first
+    images = catalog.snapshot().images
 
     # Compare the list of images to list of accepted images
     generated_urls = [f"/generated_images/{img.name}" for img in images]